@@ -1,35 +1,123 @@
 # ====================== Imports ======================
 # Library imports
-import requests
 import pandas as pd # (https://pandas.pydata.org/)
-import asyncio
+import orjson # (https://github.com/ijl/orjson)
+import threading
+import itertools
+import time
 
 # Local imports
-from classes.interface_classes import Interface, DataStore, SymbolsManagerBase
+from classes.interface_classes import Interface, DataStore, SymbolsManagerBase, ResponseCache, TokenBucket, create_session, aget, REQUEST_TIMEOUT
 
 # Binance imports (https://binance-docs.github.io/apidocs/spot/en/#introduction)
 from binance.spot import Spot as Client
 from binance.websocket.spot.websocket_api import SpotWebsocketAPIClient
 
 
+# Shared connection pool for all REST calls to this exchange
+_SESSION = create_session()
+_RATE_LIMITER = TokenBucket(rate=5, burst=10) # 1200 request weight per minute per IP, most market endpoints weigh 2 or more
+CALLBACK_TIMEOUT = 60 # in seconds, how long a websocket API request's callback waits for its response
+
 # ====================== Classes ======================
 
+class BinanceMultiplexClient:
+    """
+    Shares one websocket API connection between all symbols.
+    Each request is sent with its own id, and the response is passed to the callback registered for that id.
+    Binance closes connections at least every 24 hours - get_instance then opens a new one. Callbacks for requests
+    that get no response within CALLBACK_TIMEOUT seconds are dropped.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._callbacks = {} # request id -> (callback_func, time it expires)
+        self._callbacks_lock = threading.Lock()
+        self._ids = itertools.count()
+        self.closed = False
+        self._ws_client = SpotWebsocketAPIClient(on_message=self._dispatch, on_close=self._on_close, on_error=self._on_error)
+
+    @classmethod
+    def get_instance(cls):
+        with cls._instance_lock:
+            if cls._instance is not None and cls._instance.closed:
+                cls._instance.stop()
+                cls._instance = None
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _on_close(self, *args):
+        self.closed = True
+
+    def _on_error(self, *args):
+        print(f"Binance websocket error - {args[-1]}")
+
+    def stop(self):
+        self.closed = True
+        with self._callbacks_lock:
+            self._callbacks.clear()
+        try:
+            self._ws_client.stop()
+        except Exception:
+            pass # connection is already gone
+
+    def _expire_callbacks(self):
+        # caller must hold self._callbacks_lock
+        now = time.monotonic()
+        for request_id in [request_id for request_id, (_, expires) in self._callbacks.items() if expires < now]:
+            del self._callbacks[request_id]
+
+    def _dispatch(self, ws, message):
+        if type(message) is str:
+            message = orjson.loads(message)
+        with self._callbacks_lock:
+            callback_func, _ = self._callbacks.pop(message.get("id"), (None, None))
+            self._expire_callbacks()
+        if callback_func is not None:
+            callback_func(ws, message)
+
+    def klines(self, symbol: str, interval: str, callback_func, limit: int = 1):
+        request_id = f"{symbol}-{next(self._ids)}"
+        with self._callbacks_lock:
+            self._expire_callbacks()
+            self._callbacks[request_id] = (callback_func, time.monotonic() + CALLBACK_TIMEOUT)
+        try:
+            self._ws_client.klines(symbol=symbol, interval=interval, limit=limit, id=request_id)
+        except Exception as e:
+            # the connection has gone - the next get_instance opens a new one, so the caller's next request goes through
+            print(f"Binance websocket request {request_id} failed - {e}")
+            self.closed = True
+            with self._callbacks_lock:
+                self._callbacks.pop(request_id, None)
+
+
 class BinanceAPI(Interface):
     def __init__(self, access_key, secret_key, host="api.binance.com"):
         super().__init__(access_key, secret_key, host)
         self.__access_key = access_key
         self.__secret_key = secret_key
         self.__host = host
+        self.__base_url = f"https://{host}"
+        self.__symbols_cache = ResponseCache(_SESSION, host)
 
     def __get(self, path, params=None):
-        return requests.get("https://{host}{path}".format(host=self.__host, path=path), params=params).json()
+        _RATE_LIMITER.acquire()
+        response = _SESSION.get(self.__base_url + path, params=params, timeout=REQUEST_TIMEOUT)
+        return orjson.loads(response.content)
 
     def get_symbols(self):
-        return self.__get("/api/v3/exchangeInfo")["symbols"]
+        return self.__symbols_cache.get("/api/v3/exchangeInfo")["symbols"]
     
     def get_kline_history(self, symbol, interval, limit):
         return self.__get("/api/v3/klines", {"symbol": symbol, "interval": interval, "limit": limit})
 
+    async def get_kline_history_async(self, session, symbol, interval, limit, rate_controller=None):
+        # session is an aiohttp.ClientSession - see create_async_session
+        await _RATE_LIMITER.aacquire()
+        return await aget(session, self.__base_url + "/api/v3/klines", {"symbol": symbol, "interval": interval, "limit": str(limit)}, rate_controller)
+
     def subscribe_to_candlestick(self, symbol="btcusdt", interval="1m", callback_func=None):
         def callback(_, kline_data):
             print(kline_data)
@@ -37,13 +125,8 @@ class BinanceAPI(Interface):
         if (callback_func == None):
             callback_func = callback
 
-        async def subscribe():
-            ws_client = SpotWebsocketAPIClient(on_message=callback_func)
-            ws_client.klines(symbol=symbol, interval=interval, limit=1) # only get the last candlestick
-        
-        async_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(async_loop)
-        async_loop.run_until_complete(subscribe())
+        # only get the last candlestick - request goes over the websocket shared by all symbols
+        BinanceMultiplexClient.get_instance().klines(symbol, interval, callback_func)
 
     def request_trades(self, symbol="btcusdt", callback_func=None):
         pass
@@ -57,7 +140,7 @@ class BinanceSymbolsManager(SymbolsManagerBase):
         df = pd.DataFrame().from_dict(symbols)
         return df
 
-    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: list = ["BTCUSDT", "ETHUSDT"]):
+    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: frozenset = frozenset({"BTCUSDT", "ETHUSDT"})):
         # Filter out Ethereum and Bitcoin
         symbols = symbols[~symbols['baseAsset'].isin(excluded_coins)]
         symbols = symbols[~symbols['quoteAsset'].isin(excluded_coins)]
@@ -72,6 +155,11 @@ class BinanceSymbolsManager(SymbolsManagerBase):
     
     def convert_to_list(self, symbols: pd.DataFrame):
         return symbols['symbol'].tolist()
+
+    def pick_tradable(self, symbols: list, excluded_coins: frozenset = frozenset()):
+        # Same result as filter_offline + filter_excluded + convert_to_list, in one pass over the raw list without building a DataFrame
+        excluded_coins = frozenset(excluded_coins)
+        return [s["symbol"] for s in symbols if s["status"] == "TRADING" and s["baseAsset"] not in excluded_coins and s["quoteAsset"] not in excluded_coins]
         
 
 
@@ -0,0 +1,62 @@
+"""
+Compiled helpers for cleaning batches of numeric market data before they are stored
+
+Functions:
+    valid_kline_rows: Returns a mask of kline rows that are complete
+    clean_klines: Drops incomplete rows from a batch of formatted klines
+"""
+# ================ Imports ================
+import collections
+import numpy as np # (https://numpy.org/)
+import numba # (https://numba.pydata.org/)
+
+# ================ Functions ================
+@numba.njit(cache=True)
+def valid_kline_rows(klines: np.ndarray) -> np.ndarray:
+    """
+    Returns a boolean mask over the rows of an (N, M) float64 kline array.
+    A row is valid if every value is finite and the timestamp (column 0) is positive.
+    Compiled once and cached on disk, so only the first ever run pays the compile time.
+    """
+    n_rows, n_cols = klines.shape
+    valid = np.ones(n_rows, dtype=np.bool_)
+    for i in range(n_rows):
+        if not klines[i, 0] > 0:
+            valid[i] = False
+            continue
+        for j in range(n_cols):
+            if not np.isfinite(klines[i, j]):
+                valid[i] = False
+                break
+    return valid
+
+def clean_klines(rows: list) -> list:
+    """
+    Drops rows with missing or non-numeric values from a batch of formatted klines.
+    Exchanges return numbers as strings or numbers, so values are coerced to float64 for the check,
+    but the surviving rows are returned unchanged so the csv output keeps the exchange's formatting.
+    """
+    if len(rows) == 0:
+        return rows
+    try:
+        klines = np.asarray(rows, dtype=np.float64)
+    except (ValueError, TypeError):
+        klines = _coerce_rows(rows)
+    valid = valid_kline_rows(klines)
+    return [row for row, keep in zip(rows, valid) if keep]
+
+def _coerce_rows(rows: list) -> np.ndarray:
+    """
+    Row by row version of the float64 conversion in clean_klines, for batches containing a non-numeric or ragged row.
+    Rows that can't be converted, or don't have the batch's usual number of values, are left as NaN so they are dropped.
+    """
+    n_cols = collections.Counter(len(row) for row in rows).most_common(1)[0][0]
+    klines = np.full((len(rows), n_cols), np.nan)
+    for i, row in enumerate(rows):
+        if len(row) != n_cols:
+            continue
+        try:
+            klines[i] = np.asarray(row, dtype=np.float64)
+        except (ValueError, TypeError):
+            pass
+    return klines
@@ -3,17 +3,131 @@ Classes that each exchange interface should inherit from, to ensure consistency
 
 API classes:
     Interface: Base class for all exchange interfaces
+    ResponseCache: Caches slow-changing REST responses on disk
+    RateController: Adapts request concurrency to the exchange's rate limits
+    TokenBucket: Paces requests to the exchange's published request rate
 
 Other general classes:
     DataStore: Stores data from API
     SymbolsManager: Provides utility functions for symbols
+
+Functions:
+    create_session: Creates a pooled HTTP session for exchange REST calls
+    create_async_session: Creates a pooled aiohttp session for concurrent REST calls
+    new_event_loop: Creates an event loop, using uvloop when installed
+    run_async: Runs a coroutine to completion on a new_event_loop, like asyncio.run
 """
 # ================ Imports ================
 import csv
+import collections
+import array
+import atexit
+import weakref
+import threading
 import pandas as pd
 import os
+import pathlib
+import time
+import orjson # (https://github.com/ijl/orjson)
+import requests
+import aiohttp
+import aiofiles # (https://github.com/Tinche/aiofiles)
+import aiocsv # (https://github.com/MKuranowski/aiocsv)
+import asyncio
+try:
+    import pyarrow as pa # (https://arrow.apache.org/docs/python/) - only needed for parquet DataStores
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+try:
+    import uvloop # (https://github.com/MagicStack/uvloop) - not available on Windows
+except ImportError:
+    uvloop = None
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ================ Constants ================
+REQUEST_TIMEOUT = (3, 10) # (connect, read) timeout in seconds for REST calls
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "altcoin") # where ResponseCache persists responses
+CACHE_MAX_AGE = 3600 # in seconds, how long a cached response is used without asking the exchange
+TRADE_DIRECTIONS = ("buy", "sell") # trade directions as stored by DataStore.write_trades_to_csv
+# (remaining, limit) rate limit headers sent by exchanges, checked by RateController
+RATE_LIMIT_HEADERS = [
+    ("gw-ratelimit-remaining", "gw-ratelimit-limit"), # kucoin
+    ("X-HB-RateLimit-Requests-Remain", "X-HB-RateLimit-Requests-Limit"), # huobi
+]
+_OPEN_STORES = weakref.WeakSet() # DataStores not closed yet, flushed on exit - weak so unclosed stores can still be freed
+_CLEAN_TABLE = str.maketrans({"\n": "", " ": "", ",": ""}) # characters removed from strings before writing to csv
+
+# ================ Functions ================
+def create_session(pool_connections: int = 16, pool_maxsize: int = 64):
+    """
+    Returns a requests Session that keeps connections alive between calls,
+    so each request reuses an open TCP/TLS connection instead of handshaking again.
+    Transient errors (rate limiting, gateway errors) are retried with backoff.
+    """
+    retries = Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def create_async_session(limit: int = 64):
+    """
+    Returns an aiohttp ClientSession for issuing many REST calls from one event loop.
+    Must be created (and closed) inside the running loop.
+    """
+    connector = aiohttp.TCPConnector(limit=limit, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def new_event_loop():
+    """Returns a new event loop - uvloop's libuv based loop if installed, otherwise asyncio's default"""
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+def run_async(coroutine):
+    """Runs coroutine on a new event loop (see new_event_loop) and returns its result, closing the loop afterwards"""
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def _flush_open_stores():
+    for store in list(_OPEN_STORES):
+        store.flush()
+
+atexit.register(_flush_open_stores) # write out any remaining rows on exit
+
+async def aget(session, url: str, params: dict = None, rate_controller: "RateController" = None):
+    """
+    Async equivalent of the interfaces' __get helpers, using a session from create_async_session.
+    If rate_controller is given, it is updated from the response status and headers.
+    Raises RateLimitedError on a 429, so the caller can retry the request.
+    """
+    async with session.get(url, params=params) as response:
+        if rate_controller is not None:
+            rate_controller.update(response.status, response.headers)
+        if response.status == 429:
+            retry_after = response.headers.get("Retry-After")
+            raise RateLimitedError(url, float(retry_after) if retry_after else None)
+        return orjson.loads(await response.read())
 
 # ================ Classes ================
+class RateLimitedError(Exception):
+    """Raised by aget when the exchange rejects a request as rate limited (429). retry_after is in seconds, or None if not sent"""
+    def __init__(self, url: str, retry_after: float = None):
+        super().__init__(f"Rate limited requesting {url}")
+        self.url = url
+        self.retry_after = retry_after
+
+
 class Interface():
     """
     Defines public functions to interact with exchange API
@@ -27,6 +141,9 @@ class Interface():
     def get_kline_history(self, symbol, interval, limit):
         pass
 
+    async def get_kline_history_async(self, session, symbol, interval, limit, rate_controller=None):
+        pass
+
     def subscribe_to_candlestick(self, symbol, interval, callback_func):
         pass
 
@@ -34,38 +151,236 @@ class Interface():
         pass
 
 
+class ResponseCache:
+    """
+    Caches JSON responses for slow-changing endpoints (e.g. symbol lists) in memory and on disk.
+    A cached response younger than max_age is returned without a request, otherwise it is
+    revalidated with If-None-Match so an unchanged response (304) is not downloaded and parsed again.
+    """
+    def __init__(self, session: requests.Session, host: str, cache_dir: str = CACHE_DIR, max_age: int = CACHE_MAX_AGE):
+        self.session = session
+        self.host = host
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self._cache = {} # path -> (etag, body)
+
+    def _cache_file(self, path: str):
+        return os.path.join(self.cache_dir, "{host}_{path}.json".format(host=self.host, path=path.strip("/").replace("/", "_")))
+
+    def _read(self, path: str):
+        if path in self._cache:
+            return self._cache[path]
+        try:
+            with open(self._cache_file(path), 'rb') as f:
+                cached = orjson.loads(f.read())
+            self._cache[path] = (cached["etag"], cached["body"])
+        except (OSError, ValueError, KeyError):
+            self._cache[path] = (None, None)
+        return self._cache[path]
+
+    def _write(self, path: str, etag: str, body):
+        self._cache[path] = (etag, body)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._cache_file(path), 'wb') as f:
+                f.write(orjson.dumps({"etag": etag, "body": body}))
+        except OSError:
+            pass # cache is best effort - still have the in memory copy
+
+    def _touch(self, path: str, etag: str, body):
+        try:
+            os.utime(self._cache_file(path))
+        except OSError:
+            self._write(path, etag, body) # cache file is missing - write it again from the in memory copy
+
+    def _is_fresh(self, path: str):
+        try:
+            return time.time() - os.path.getmtime(self._cache_file(path)) < self.max_age
+        except OSError:
+            return False
+
+    def get(self, path: str):
+        etag, body = self._read(path)
+        if body is not None and self._is_fresh(path):
+            return body
+
+        headers = {"If-None-Match": etag} if etag else {}
+        response = self.session.get(f"https://{self.host}{path}", headers=headers, timeout=REQUEST_TIMEOUT)
+        # error bodies (bans, rate limits) must never be cached, or they would be served for max_age
+        response.raise_for_status()
+        if response.status_code == 304 and body is not None:
+            self._touch(path, etag, body) # still valid - restart max_age without rewriting the body
+            return body
+        if response.status_code != 200:
+            raise requests.HTTPError(f"Unexpected status {response.status_code} for {path}, not caching", response=response)
+        body = orjson.loads(response.content)
+        self._write(path, response.headers.get("ETag"), body)
+        return body
+
+
+class TokenBucket:
+    """
+    Paces requests to rate per second, allowing bursts of up to burst requests.
+    Shared by every thread and task using an exchange, so requests are spaced out before the exchange has to reject them.
+    acquire blocks the calling thread, aacquire awaits without blocking the event loop.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Takes a token, returning how many seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= 1 # may go negative - later callers queue behind the tokens already reserved
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class RateController:
+    """
+    Limits how many requests are in flight, adjusting the limit with AIMD (additive increase, multiplicative decrease):
+    each successful response raises the limit by increase, and a rate limited response (429, or little quota left
+    according to the exchange's headers) multiplies it by decrease and pauses new requests for Retry-After seconds.
+    Use as `async with rate_controller:` around each request.
+    """
+    def __init__(self, initial_limit: float, min_limit: float = 1, max_limit: float = 64, increase: float = 0.5, decrease: float = 0.5, low_quota: float = 0.1, default_pause: float = 1):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.low_quota = low_quota # fraction of quota remaining at which to back off
+        self.default_pause = default_pause # in seconds, pause after a 429 without Retry-After
+        self.active = 0
+        self._paused_until = 0
+        self._condition = None # created lazily so it binds to the running loop
+
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def _throttle(self, pause: float):
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def update(self, status: int, headers):
+        retry_after = headers.get("Retry-After")
+        if status == 429:
+            self._throttle(float(retry_after) if retry_after else self.default_pause)
+            return
+        for remaining_header, limit_header in RATE_LIMIT_HEADERS:
+            remaining, quota = headers.get(remaining_header), headers.get(limit_header)
+            if remaining is not None and quota is not None and float(remaining) < self.low_quota * float(quota):
+                self._throttle(float(retry_after) if retry_after else 0)
+                return
+        self.limit = min(self.max_limit, self.limit + self.increase)
+
+
 class DataStore:
     """
     Stores data from API
+    Rows are written to a csv file by default. With file_format="parquet", each batch is written as a zstd compressed
+    row group of a parquet file named by csv_name (zstd level 1), with the given column names. Parquet files can't be appended to
+    across runs, so the file is rewritten each time a parquet DataStore is created.
     """
-    def __init__(self, exchange: str, symbol: str, metric: str, csv_name: str = None, id_buffer_size: int = 1000):
+    def __init__(self, exchange: str, symbol: str, metric: str, csv_name: str = None, id_buffer_size: int = 1000, flush_threshold: int = 1024, flush_interval: float = 2.0, data_buffer_size: int = 1024, file_format: str = "csv", columns: list = None):
         self.exchange = exchange
-        self.data = []
+        self.data = collections.deque(maxlen=data_buffer_size) # most recent data only - full history is in the csv
         self.symbol = symbol
         self.metric = metric
+        self.file_format = file_format
+        self.columns = columns
+        if self.file_format not in ("csv", "parquet"):
+            raise Exception(f"Unsupported file format {self.file_format}")
+        if self.file_format == "parquet" and (pq is None or self.columns is None):
+            raise Exception("Parquet DataStores need pyarrow installed and column names")
         self.csv_name = self._set_csv_name(csv_name)
         self._create_csv()
-        #self._empty_csv()
         self.id_buffer_size = id_buffer_size
-        self.timestamps = {}
+        self.timestamps = collections.OrderedDict() # most recent ids, oldest evicted first
+
+        # Rows are buffered and written in batches to a file kept open for the lifetime of the store.
+        # A batch is written once flush_threshold rows are pending, or by the first write that comes more than
+        # flush_interval seconds after the last flush. The age is only checked when a row is written - there is no timer,
+        # so rows buffered by a store that then goes idle stay pending until the next write, flush, close or exit.
+        self.flush_threshold = flush_threshold
+        self.flush_interval = flush_interval
+        self._pending = []
+        # Trades are buffered column-wise in typed arrays (see write_trades_to_csv) rather than as a list per row
+        self._trade_ids = array.array('q')
+        self._trade_prices = array.array('d')
+        self._trade_amounts = array.array('d')
+        self._trade_directions = bytearray() # index into TRADE_DIRECTIONS
+        self._trade_ts = array.array('q')
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._fh = None # csv handle used by the sync writers - opened on first use, so stores only written from the loop don't hold one
+        self._writer = None
+        self._parquet_writer = None # created with the first batch, as the schema is taken from it
+        self._async_fh = None # aiofiles handle used by the awrite_* methods
+        self._async_writer = None
+        _OPEN_STORES.add(self)
+
+    def __del__(self):
+        # a store dropped without being closed still writes its buffered rows
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
 
     def _set_csv_name(self, csv_name: str):
         name = csv_name
         if csv_name is None:
-            name = f"data/{self.exchange}/{self.metric}/{self.symbol}.csv"
+            name = f"data/{self.exchange}/{self.metric}/{self.symbol}.{self.file_format}"
         return name
     
-    def _empty_csv(self):
-        """Remove current contents of csv file"""
-        with open(self.csv_name, 'w') as f:
-            pass
-    
     def _create_csv(self):
-        """Create csv file if it doesn't exist. 
+        """Create the csv file's folder if it doesn't exist. The file itself is created by the first write, which opens it
+        in append mode, keeping any existing data. Folders are normally created up front by create_data_dirs in main.
         If this fails, it's likely a permissions error. Try creating the data folders manually.
         """
-        f = open(self.csv_name, 'w')
-        f.close()
+        csv_dir = pathlib.Path(self.csv_name).parent
+        if not csv_dir.is_dir():
+            csv_dir.mkdir(parents=True, exist_ok=True)
 
     def store_data(self, data):
         self.data.append(data)
@@ -75,34 +390,171 @@ class DataStore:
     
     def write_to_csv_string(self, data):
         data = self._clean_data(data)
-        with open(self.csv_name, 'a') as f:
-            writer = csv.writer(f)
-            writer.writerow(data)
+        self._add_pending(data)
     
     def write_data_to_csv(self, data: list, id_index: int = 0, error_msg: str = "Duplicate ID"):
         data = self._clean_data(data)
         # Check timestamp is unique
-        if data[id_index] in self.timestamps:
+        if not self._check_unique_id(data[id_index]):
             #raise Exception(error_msg)
             return # Return instead of raising exception to reduce log spam - can be uncommented for debugging
-        else:
-            self.timestamps[data[0]] = True
+        self._add_pending(data)
 
-        with open(self.csv_name, 'a') as f:
-            writer = csv.writer(f)
-            writer.writerow(data)
+    def write_rows_to_csv(self, rows: list, id_index: int = 0):
+        """Same as write_data_to_csv for a whole batch of rows, taking the buffer lock once"""
+        rows = [self._clean_data(row) for row in rows]
+        rows = [row for row in rows if self._check_unique_id(row[id_index])]
+        with self._lock:
+            self._check_open()
+            self._pending.extend(rows)
+            if self._should_flush():
+                self._write_pending()
+
+    def write_trades_to_csv(self, trades):
+        """
+        Buffers (trade_id, price, amount, direction, ts) tuples, skipping duplicate trade ids.
+        Written to the csv in the same column order as write_rows_to_csv would.
+        """
+        with self._lock:
+            self._check_open()
+            for trade_id, price, amount, direction, ts in trades:
+                direction = TRADE_DIRECTIONS.index(direction) # before any append, so a bad row can't misalign the columns
+                if not self._check_unique_id(trade_id):
+                    continue
+                self._trade_ids.append(trade_id)
+                self._trade_prices.append(price)
+                self._trade_amounts.append(amount)
+                self._trade_directions.append(direction)
+                self._trade_ts.append(ts)
+            if self._should_flush():
+                self._write_pending()
+
+    async def awrite_data_to_csv(self, data: list, id_index: int = 0):
+        """
+        Async version of write_data_to_csv for callbacks that run inside an event loop. csv DataStores only.
+        Full batches are written with aiofiles so the loop is not blocked on disk.
+        """
+        await self.awrite_rows_to_csv([data], id_index)
+
+    async def awrite_rows_to_csv(self, rows: list, id_index: int = 0):
+        """
+        Async version of write_rows_to_csv. As with the sync writers, the flush_interval age is only checked on a write,
+        so rows left pending when a stream goes quiet are written by the next write, aclose or exit.
+        """
+        rows = [self._clean_data(row) for row in rows]
+        rows = [row for row in rows if self._check_unique_id(row[id_index])]
+        with self._lock:
+            self._check_open()
+            self._pending.extend(rows)
+            if not self._should_flush():
+                return
+            rows = self._pending
+            self._pending = []
+            self._last_flush = time.monotonic()
+        await self._awrite_rows(rows)
+
+    async def _awrite_rows(self, rows: list):
+        if self._async_writer is None:
+            # opened on first use so the handle belongs to the running loop
+            self._async_fh = await aiofiles.open(self.csv_name, 'a', newline='')
+            self._async_writer = aiocsv.AsyncWriter(self._async_fh)
+        await self._async_writer.writerows(rows)
+        await self._async_fh.flush()
+
+    def _add_pending(self, row: list):
+        with self._lock:
+            self._check_open()
+            self._pending.append(row)
+            if self._should_flush():
+                self._write_pending()
+
+    def _check_open(self):
+        # caller must hold self._lock - rows buffered after close would never be written
+        if self._closed:
+            raise ValueError(f"DataStore for {self.csv_name} is closed")
+
+    def _should_flush(self):
+        # caller must hold self._lock
+        return len(self._pending) + len(self._trade_ids) >= self.flush_threshold or time.monotonic() - self._last_flush > self.flush_interval
+
+    def _write_pending(self):
+        # caller must hold self._lock
+        if self._pending:
+            self._write_rows(self._pending)
+            self._pending.clear()
+        if self._trade_ids:
+            directions = [TRADE_DIRECTIONS[d] for d in self._trade_directions]
+            self._write_rows(list(zip(self._trade_ids, self._trade_prices, self._trade_amounts, directions, self._trade_ts)))
+            for column in (self._trade_ids, self._trade_prices, self._trade_amounts, self._trade_directions, self._trade_ts):
+                del column[:]
+        self._last_flush = time.monotonic()
+        if self._fh is not None:
+            self._fh.flush()
+
+    def _write_rows(self, rows: list):
+        # caller must hold self._lock
+        if self.file_format == "csv":
+            if self._writer is None:
+                self._check_open()
+                # buffer sized to hold a full batch, so each flush is normally a single write call
+                self._fh = open(self.csv_name, 'a', newline='', buffering=1 << 18)
+                self._writer = csv.writer(self._fh)
+            self._writer.writerows(rows)
+            return
+        # the first batch's inferred types become the file's schema, later batches are converted to it
+        types = [None] * len(self.columns) if self._parquet_writer is None else self._parquet_writer.schema.types
+        batch = pa.RecordBatch.from_arrays([pa.array(column, type=column_type) for column, column_type in zip(zip(*rows), types)], names=self.columns)
+        if self._parquet_writer is None:
+            # low zstd level - higher levels slow writes a lot for little size gain
+            self._parquet_writer = pq.ParquetWriter(self.csv_name, batch.schema, compression="zstd", compression_level=1)
+        self._parquet_writer.write_batch(batch)
+
+    def flush(self):
+        """Write any buffered rows to the file"""
+        with self._lock:
+            if self._closed:
+                return
+            self._write_pending()
+
+    def close(self):
+        """Flush buffered rows and close the file"""
+        self.flush()
+        with self._lock:
+            self._closed = True
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+                self._writer = None
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+                self._parquet_writer = None
+        _OPEN_STORES.discard(self)
+
+    async def aclose(self):
+        """Async version of close, also closing the handle used by the awrite_* methods"""
+        if self.file_format == "csv":
+            # rows left pending by the awrite_* methods go through the async handle, rather than opening the sync one just to close
+            with self._lock:
+                rows = [] if self._closed else self._pending
+                self._pending = []
+            if rows:
+                await self._awrite_rows(rows)
+        self.close()
+        if self._async_fh is not None:
+            await self._async_fh.close()
+            self._async_fh = None
+            self._async_writer = None
 
     def _clean_data(self, data: list):
-        # Remove newlines, spaces, and commas from strings
+        # Remove newlines, spaces, and commas from strings in a single pass
         for i in range(len(data)):
             if isinstance(data[i], str):
-                data[i] = data[i].replace("\n", "")
-                data[i] = data[i].replace(" ", "")
-                data[i] = data[i].replace(",", "")
+                data[i] = data[i].translate(_CLEAN_TABLE)
         return data
     
     def _check_unique_id(self, id: str):
         if id in self.timestamps:
+            self.timestamps.move_to_end(id)
             return False
         else:
             self.timestamps[id] = True
@@ -122,17 +574,15 @@ class SymbolsManagerBase:
     def convert_to_dataframe(self, symbols: list):
         pass
 
-    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: list = []):
-        filtered_symbols = []
-        for index, row in symbols.iterrows():
-            if row["data"]["symbol"] not in excluded_coins:
-                filtered_symbols.append(row["data"]["symbol"])
-        return filtered_symbols
+    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: frozenset = frozenset()):
+        # symbols is flat - one row per symbol, one column per field (see convert_to_dataframe)
+        return symbols.loc[~symbols["symbol"].isin(excluded_coins), "symbol"].tolist()
     
     def filter_offline(self, symbols: pd.DataFrame, key: str = "state", value: str = "online"):
-        filtered_symbols = []
-        for index, row in symbols.iterrows():
-            if row["data"][key] == value:
-                filtered_symbols.append(row["data"]["symbol"])
-        return filtered_symbols
+        return symbols.loc[symbols[key] == value, "symbol"].tolist()
+
+    def pick_tradable(self, symbols: list, excluded_coins: frozenset = frozenset(), key: str = "state", value: str = "online"):
+        # Same result as filter_offline + filter_excluded, straight from the list of symbol dicts without building a DataFrame
+        excluded_coins = frozenset(excluded_coins)
+        return [s["symbol"] for s in symbols if s[key] == value and s["symbol"] not in excluded_coins]
     
@@ -1,6 +1,7 @@
 import threading
 import websocket
 import gzip
+import orjson
 import ssl
 import logging
 import urllib.parse
@@ -163,10 +164,10 @@ class WebsocketManage:
         self.last_receive_time = get_current_timestamp()
         if isinstance(message, (str)): # V2
             # print("RX string : ", message)
-            dict_data = json.loads(message)
+            dict_data = orjson.loads(message)
         elif isinstance(message, (bytes)): # V1
             # print("RX bytes: " + gzip.decompress(message).decode("utf-8"))
-            dict_data = json.loads(gzip.decompress(message).decode("utf-8"))
+            dict_data = orjson.loads(gzip.decompress(message))
         else:
             print("RX unknow type : ", type(message))
             return
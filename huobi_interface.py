@@ -1,10 +1,15 @@
 # ====================== Imports ======================
 # Library imports
-import requests
 import pandas as pd # (https://pandas.pydata.org/)
+import orjson # (https://github.com/ijl/orjson)
+import gzip
+import asyncio
+import logging
+import time
+import websockets # (https://websockets.readthedocs.io/en/stable/intro.html)
 
 # Local imports
-from classes.interface_classes import Interface, DataStore, SymbolsManagerBase
+from classes.interface_classes import Interface, DataStore, SymbolsManagerBase, ResponseCache, TokenBucket, create_session, aget, REQUEST_TIMEOUT
 
 # HuobiSDK imports (https://huobiapi.github.io/docs/spot/v1/en/#change-log)
 import huobi as hb
@@ -13,20 +18,36 @@ from huobi.constant import *
 from huobi.exception.huobi_api_exception import HuobiApiException
 from huobi.model.market import *
 
+# Shared connection pool for all REST calls to this exchange
+_SESSION = create_session()
+_RATE_LIMITER = TokenBucket(rate=10, burst=10) # market data limit is 100 requests per 10 seconds per IP
+WS_MARKET_URL = "wss://api.huobi.pro/ws"
+RECONNECT_MIN_DELAY = 1 # in seconds, first wait before reconnecting a dropped stream - doubled on each failed attempt
+RECONNECT_MAX_DELAY = 60
+logger = logging.getLogger(__name__)
+
 # ====================== Classes ======================
 
+class HuobiSubscribeError(Exception):
+    """Raised when the market websocket rejects a subscription, e.g. for an unknown symbol"""
+
+
 class HuobiAPI(Interface):
     def __init__(self, access_key, secret_key, host="api.huobi.pro"):
         super().__init__(access_key, secret_key, host)
         self.__access_key = access_key
         self.__secret_key = secret_key
         self.__host = host
+        self.__base_url = f"https://{host}"
+        self.__symbols_cache = ResponseCache(_SESSION, host)
 
     def __get(self, path, params=None):
-        return requests.get("https://{host}{path}".format(host=self.__host, path=path), params=params).json()
+        _RATE_LIMITER.acquire()
+        response = _SESSION.get(self.__base_url + path, params=params, timeout=REQUEST_TIMEOUT)
+        return orjson.loads(response.content)
 
     def get_symbols(self):
-        return self.__get("/v1/common/symbols")
+        return self.__symbols_cache.get("/v1/common/symbols")
 
     #def get_candlestick(self, symbol, interval, size):
     #    return self.__get("/market/history/kline", {"symbol": symbol, "period": interval, "size": size})
@@ -34,6 +55,11 @@ class HuobiAPI(Interface):
     def get_kline_history(self, symbol, interval, limit):
         return self.__get("/market/history/kline", {"symbol": symbol, "period": interval, "size": limit})
 
+    async def get_kline_history_async(self, session, symbol, interval, limit, rate_controller=None):
+        # session is an aiohttp.ClientSession - see create_async_session
+        await _RATE_LIMITER.aacquire()
+        return await aget(session, self.__base_url + "/market/history/kline", {"symbol": symbol, "period": interval, "size": str(limit)}, rate_controller)
+
     def subscribe_to_candlestick(self, symbol="btcusdt", interval="1min", callback_func=None):
         def callback(candlestick_event: 'CandlestickEvent'):
             candlestick_event.print_object()
@@ -59,20 +85,111 @@ class HuobiAPI(Interface):
             callback_func = callback
         market_client.req_trade_detail(symbol, callback_func, error)
 
+    async def stream_trades(self, symbol, callback_func, duration, semaphore: asyncio.Semaphore = None):
+        """
+        Subscribes to trades for symbol and awaits callback_func(trades) for each pushed list of trade dicts,
+        until duration seconds have passed, reconnecting if the connection drops. If semaphore is given, it is held
+        only while connecting and subscribing, to limit how many connections are opened at once.
+        """
+        async def trades_callback(tick):
+            await callback_func(tick["data"])
+        await self._stream(f"market.{symbol}.trade.detail", symbol, trades_callback, duration, semaphore)
+
+    async def stream_klines(self, symbol, interval, callback_func, duration, semaphore: asyncio.Semaphore = None):
+        """
+        Same as stream_trades for klines - awaits callback_func(kline) for each pushed kline dict
+        {id (unix time), open, close, low, high, amount, vol, count}
+        """
+        await self._stream(f"market.{symbol}.kline.{interval}", symbol, callback_func, duration, semaphore)
+
+    async def _stream(self, channel, request_id, callback_func, duration, semaphore: asyncio.Semaphore = None):
+        """
+        Streams channel until duration seconds have passed, reconnecting with exponential backoff
+        whenever the connection is closed or fails. A rejected subscription (HuobiSubscribeError) is raised.
+        """
+        deadline = time.monotonic() + duration
+        delay = RECONNECT_MIN_DELAY
+        subscribed = False
+
+        async def stream():
+            nonlocal subscribed
+            if semaphore is None:
+                ws = await self._subscribe(channel, request_id)
+            else:
+                async with semaphore:
+                    ws = await self._subscribe(channel, request_id)
+            subscribed = True
+            async with ws:
+                async for message in ws:
+                    # market messages are gzip compressed json
+                    data = orjson.loads(gzip.decompress(message))
+                    if "ping" in data:
+                        await ws.send(orjson.dumps({"pong": data["ping"]}).decode())
+                    elif "tick" in data:
+                        await callback_func(data["tick"])
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            subscribed = False
+            try:
+                await asyncio.wait_for(stream(), timeout=remaining)
+                reason = "connection closed by server"
+            except asyncio.TimeoutError as e:
+                # also raised by a connect or handshake that timed out - only the deadline ends the stream
+                if time.monotonic() >= deadline:
+                    return
+                reason = repr(e)
+            except (websockets.WebSocketException, OSError) as e:
+                # WebSocketException covers dropped connections and rejected upgrades (e.g. a 429 or 503 from the server)
+                reason = repr(e)
+            if subscribed:
+                delay = RECONNECT_MIN_DELAY # the last connection worked, so reconnect promptly
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            logger.warning("Huobi stream %s dropped (%s), reconnecting in %ss", channel, reason, delay)
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _subscribe(self, channel, request_id):
+        """Connects and subscribes to channel, waiting for the server's reply. Raises HuobiSubscribeError if it is rejected"""
+        ws = await websockets.connect(WS_MARKET_URL)
+        try:
+            await ws.send(orjson.dumps({"sub": channel, "id": request_id}).decode())
+            while True:
+                data = orjson.loads(gzip.decompress(await ws.recv()))
+                if "ping" in data:
+                    await ws.send(orjson.dumps({"pong": data["ping"]}).decode())
+                elif "status" in data:
+                    break
+            if data["status"] != "ok":
+                logger.error("Huobi subscription to %s failed: %s %s", channel, data.get("err-code"), data.get("err-msg"))
+                raise HuobiSubscribeError(f"{channel} - {data.get('err-code')} {data.get('err-msg')}")
+        except BaseException:
+            await ws.close()
+            raise
+        return ws
+
 
 class HuobiSymbolsManager(SymbolsManagerBase):
     def __init__(self, interface: Interface):
         self.interface = interface
 
     def convert_to_dataframe(self, symbols: list):
-        df = pd.DataFrame().from_dict(symbols)
+        # flatten the response's "data" list so each symbol field is its own column
+        df = pd.DataFrame(symbols["data"])
         return df
 
-    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: list = []):
+    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: frozenset = frozenset()):
         return super().filter_excluded(symbols, excluded_coins)
     
     def filter_offline(self, symbols: pd.DataFrame):
         return super().filter_offline(symbols)
+
+    def pick_tradable(self, symbols: dict, excluded_coins: frozenset = frozenset()):
+        return super().pick_tradable(symbols["data"], excluded_coins)
         
 
 
@@ -1,32 +1,84 @@
 # =================== Imports ===================
 # Library imports
-import requests
 import pandas as pd # (https://pandas.pydata.org/)
+import orjson # (https://github.com/ijl/orjson)
 import websockets # (https://websockets.readthedocs.io/en/stable/intro.html)
 import asyncio
+import threading
+import time
 
 # Internal imports
-from classes.interface_classes import Interface, DataStore, SymbolsManagerBase
+from classes.interface_classes import Interface, DataStore, SymbolsManagerBase, ResponseCache, TokenBucket, create_session, aget, new_event_loop, REQUEST_TIMEOUT
 
 # Kucoin SDK imports (https://docs.kucoin.com/#client-libraries)
 from kucoin.client import WsToken
 from kucoin.ws_client import KucoinWsClient
 
 
+# Shared connection pool for all REST calls to this exchange
+_SESSION = create_session()
+_RATE_LIMITER = TokenBucket(rate=10, burst=10) # public limit is 30 requests per 3 seconds per IP
+
 # =================== Classes ===================
 
+class KucoinMultiplexClient:
+    """
+    Shares one websocket connection, running on one background event loop, between all symbols.
+    Messages are passed to the callback registered for their topic.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, access_key, secret_key):
+        self._callbacks = {}
+        self._loop = new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="kucoin_ws_loop", daemon=True).start()
+        self._ws_client = self._run(self._create_client(WsToken(access_key, secret_key)))
+
+    @classmethod
+    def get_instance(cls, access_key, secret_key):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(access_key, secret_key)
+            return cls._instance
+
+    def _run(self, coroutine):
+        # run coroutine on the background loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _create_client(self, ws_token):
+        return await KucoinWsClient.create(self._loop, ws_token, callback=self._dispatch)
+
+    async def _dispatch(self, message: dict):
+        callback_func = self._callbacks.get(message.get("topic"))
+        if callback_func is not None:
+            await callback_func(message)
+
+    def subscribe(self, topic: str, callback_func):
+        self._callbacks[topic] = callback_func
+        self._run(self._ws_client.subscribe(topic))
+
+    def unsubscribe(self, topic: str):
+        self._run(self._ws_client.unsubscribe(topic))
+        self._callbacks.pop(topic, None)
+
+
 class KucoinAPI(Interface):
     def __init__(self, access_key, secret_key, host="api.kucoin.com"):
         super().__init__(access_key, secret_key, host)
         self.__access_key = access_key
         self.__secret_key = secret_key
         self.__host = host
+        self.__base_url = f"https://{host}"
+        self.__symbols_cache = ResponseCache(_SESSION, host)
 
     def __get(self, path, params=None):
-        return requests.get("https://{host}{path}".format(host=self.__host, path=path), params=params).json()
+        _RATE_LIMITER.acquire()
+        response = _SESSION.get(self.__base_url + path, params=params, timeout=REQUEST_TIMEOUT)
+        return orjson.loads(response.content)
 
     def get_symbols(self):
-        return self.__get("/api/v2/symbols")
+        return self.__symbols_cache.get("/api/v2/symbols")
 
     def get_ticker(self, symbol):
         return self.__get("/api/v1/market/orderbook/level1", {"symbol": symbol})
@@ -34,23 +86,31 @@ class KucoinAPI(Interface):
     def get_kline_history(self, symbol, interval, limit):
         return self.__get("/api/v1/market/candles", {"symbol": symbol, "type": interval, "limit": limit})
 
+    async def get_kline_history_async(self, session, symbol, interval, limit, rate_controller=None):
+        # session is an aiohttp.ClientSession - see create_async_session
+        await _RATE_LIMITER.aacquire()
+        return await aget(session, self.__base_url + "/api/v1/market/candles", {"symbol": symbol, "type": interval, "limit": str(limit)}, rate_controller)
+
     def subscribe_to_candlestick(self, symbol="BTC-USDT", interval="1min", callback_func=None, duration=6000):
-        def callback(kline_data):
+        async def callback(kline_data):
             print(kline_data)
             print("\n")
         if (callback_func == None):
             callback_func = callback
 
-        async def subscribe():
-            ws_token = WsToken(self.__access_key, self.__secret_key)
-            ws_client = await KucoinWsClient.create(None, ws_token, callback=callback_func)
-            await ws_client.subscribe('/market/candles:{symbol}_{type}'.format(symbol=symbol, type=interval))
-            await asyncio.sleep(duration)
+        # subscribe on the websocket shared by all symbols, then collect for duration
+        multiplex_client = KucoinMultiplexClient.get_instance(self.__access_key, self.__secret_key)
+        topic = '/market/candles:{symbol}_{type}'.format(symbol=symbol, type=interval)
+        multiplex_client.subscribe(topic, callback_func)
+        time.sleep(duration)
+        multiplex_client.unsubscribe(topic)
 
-        async_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(async_loop)
-        async_loop.run_until_complete(subscribe())
-        
+    def run_on_ws_loop(self, coroutine):
+        """
+        Runs coroutine on the event loop that awaits the candlestick callbacks and returns its result,
+        e.g. to close a DataStore whose async handle the callbacks wrote through
+        """
+        return KucoinMultiplexClient.get_instance(self.__access_key, self.__secret_key)._run(coroutine)
 
     def request_trades(self, symbol="btcusdt", callback_func=None):
         pass
@@ -61,12 +121,16 @@ class KucoinSymbolsManager(SymbolsManagerBase):
         self.interface = interface
 
     def convert_to_dataframe(self, symbols):
-        df = pd.DataFrame().from_dict(symbols)
+        # flatten the response's "data" list so each symbol field is its own column
+        df = pd.DataFrame(symbols["data"])
         return df
 
-    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: list = ["BTC-USDT", "ETH-USDT"]):
+    def filter_excluded(self, symbols: pd.DataFrame, excluded_coins: frozenset = frozenset({"BTC-USDT", "ETH-USDT"})):
         return super().filter_excluded(symbols, excluded_coins)
     
     def filter_offline(self, symbols: pd.DataFrame):
         return super().filter_offline(symbols, "enableTrading", True)
+
+    def pick_tradable(self, symbols: dict, excluded_coins: frozenset = frozenset({"BTC-USDT", "ETH-USDT"})):
+        return super().pick_tradable(symbols["data"], excluded_coins, "enableTrading", True)
         
\ No newline at end of file
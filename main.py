@@ -5,13 +5,24 @@ import threading
 import pandas as pd # (https://pandas.pydata.org/)
 import csv
 import matplotlib.pyplot as plt # (https://matplotlib.org/)
-import json
+import orjson # (https://github.com/ijl/orjson)
+import requests
 import time
 import sys
+import logging
+import logging.handlers
+import queue
+import atexit
+import functools
+import operator
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 import websockets
 
 # local imports
-from classes.interface_classes import Interface, DataStore, SymbolsManagerBase
+from classes.interface_classes import Interface, DataStore, SymbolsManagerBase, RateController, RateLimitedError, create_async_session, run_async
+from classes.fast_clean import clean_klines
 
 # Huobi imports (https://huobiapi.github.io/docs/spot/v1/en/#change-log)
 import huobi_interface as huobi_interface
@@ -26,35 +37,96 @@ import kucoin_interface
 import binance_interface
 
 # ---------------------------- CONSTANTS ----------------------------
-#EXCLUDED_COINS = ["btcusdt","ethusdt"]
-EXCLUDED_COINS = []
+#EXCLUDED_COINS = frozenset({"btcusdt", "ethusdt"})
+EXCLUDED_COINS = frozenset() # set for O(1) membership checks
 INTERVAL = 20 # in seconds, how often to collect data
 KLINE_INTERVAL = "1hour" # interval for kline data
 KLINE_INTERVAL_SECONDS = 3600 # interval for kline data in seconds
 DURATION = 999999 # in seconds, how long to collect data for
 SIMULTANEOUS_REQUESTS = 5 # number of requests to make at once - prevents rate limiting
-SLEEP_BETWEEN_THREAD_GEN = 10 # in seconds, how long to wait between generating threads
-SLEEP_BETWEEN_HISTORY_REQUESTS = 1 # in seconds, how long to wait between history requests
 DELAY_AFTER_TIMEOUT = 20 # in seconds, how long to wait after a timeout
+RATE_LIMIT_RETRIES = 3 # times a rate limited request is retried before giving up on it
+DELAY_AFTER_RATE_LIMIT = 1 # in seconds, first wait before retrying a rate limited request without Retry-After - doubled on each retry
+KLINE_HISTORY_LIMIT = 1000 # number of klines requested per symbol by HistoricalKlines
+LOG_LEVEL = logging.WARNING # raise to logging.DEBUG to log every trade
+
+logger = logging.getLogger(__name__)
+
+# exchange -> {interval: seconds}, used by KlineIntervals
+EXCHANGE_KLINE_INTERVALS = {
+    "binance": {
+        "1m": 60,
+        "3m": 180,
+        "5m": 300,
+        "15m": 900,
+        "30m": 1800,
+        "1h": 3600,
+        "2h": 7200,
+        "1d": 86400,
+        "1w": 604800,
+        "1M": 2592000
+    },
+    "kucoin": {
+        "1min": 60,
+        "3min": 180,
+        "5min": 300,
+        "15min": 900,
+        "30min": 1800,
+        "1hour": 3600,
+        "2hour": 7200,
+        "1d": 86400,
+        "1week": 604800,
+        "1mon": 2592000
+    },
+    "huobi": {
+        "1min": 60,
+        "5min": 300,
+        "15min": 900,
+        "30min": 1800,
+        "60min": 3600,
+        "1day": 86400,
+        "1week": 604800,
+        "1mon": 2592000
+    },
+}
+# exchange -> {seconds: interval}
+EXCHANGE_KLINE_INTERVALS_BY_SECONDS = {exchange: {seconds: interval for interval, seconds in intervals.items()} for exchange, intervals in EXCHANGE_KLINE_INTERVALS.items()}
+# read only views, as KlineIntervals hands the inner tables out by reference rather than copying them
+EXCHANGE_KLINE_INTERVALS = MappingProxyType({exchange: MappingProxyType(intervals) for exchange, intervals in EXCHANGE_KLINE_INTERVALS.items()})
+EXCHANGE_KLINE_INTERVALS_BY_SECONDS = MappingProxyType({exchange: MappingProxyType(intervals) for exchange, intervals in EXCHANGE_KLINE_INTERVALS_BY_SECONDS.items()})
+
+# exchange -> API constructor, used by APIFactory
+API_CONSTRUCTORS = {
+    "huobi": lambda: huobi_interface.HuobiAPI(api_keys.hb_api_key, api_keys.hb_secret_key),
+    "kucoin": lambda: kucoin_interface.KucoinAPI(api_keys.kc_api_key, api_keys.kc_secret_key),
+    "binance": lambda: binance_interface.BinanceAPI("", ""), # no binance api keys
+}
+# exchange -> SymbolsManager class, used by SymbolManagerFactory
+SYMBOL_MANAGER_CLASSES = {
+    "huobi": huobi_interface.HuobiSymbolsManager,
+    "kucoin": kucoin_interface.KucoinSymbolsManager,
+    "binance": binance_interface.BinanceSymbolsManager,
+}
 
 # ---------------------------- CLASSES ----------------------------
 # Factory classes for exchanges
 class APIFactory:
     """
     Returns API instance for input exchange
+    One instance is shared per exchange, so threads reuse its connections instead of each creating their own
     """
     def __init__(self, exchange: str):
         self.exchange = exchange
 
     def get_api(self):
-        if self.exchange == "huobi":
-            return huobi_interface.HuobiAPI(api_keys.hb_api_key, api_keys.hb_secret_key)
-        elif self.exchange == "kucoin":
-            return kucoin_interface.KucoinAPI(api_keys.kc_api_key, api_keys.kc_secret_key)
-        elif self.exchange == "binance":
-            return binance_interface.BinanceAPI("", "") # no binance api keys
-        else:
+        return self._create_api(self.exchange)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _create_api(exchange: str):
+        if exchange not in API_CONSTRUCTORS:
             raise Exception("Exchange not supported")
+        return API_CONSTRUCTORS[exchange]()
         
 class SymbolManagerFactory:
     """
@@ -65,14 +137,9 @@ class SymbolManagerFactory:
         self.interface = interface
 
     def get_symbol_manager(self):
-        if self.exchange == "huobi":
-            return huobi_interface.HuobiSymbolsManager(self.interface)
-        elif self.exchange == "kucoin":
-            return kucoin_interface.KucoinSymbolsManager(self.interface)
-        elif self.exchange == "binance":
-            return binance_interface.BinanceSymbolsManager(self.interface)
-        else:
+        if self.exchange not in SYMBOL_MANAGER_CLASSES:
             raise Exception("Exchange not supported")
+        return SYMBOL_MANAGER_CLASSES[self.exchange](self.interface)
 
 class KlineIntervals:
     """
@@ -81,56 +148,22 @@ class KlineIntervals:
     """
     def __init__(self, exchange: str):
         self.exchange = exchange
-        self.intervals = self._set_intervals()
-
-    def _set_intervals(self):
-        kline_intervals = {}
-        if self.exchange == "binance":
-            kline_intervals = {
-                "1m": 60,
-                "3m": 180,
-                "5m": 300,
-                "15m": 900,
-                "30m": 1800,
-                "1h": 3600,
-                "2h": 7200,
-                "1d": 86400,
-                "1w": 604800,
-                "1M": 2592000
-            }
-        elif self.exchange == "kucoin":
-            kline_intervals = {
-                "1min": 60,
-                "3min": 180,
-                "5min": 300,
-                "15min": 900,
-                "30min": 1800,
-                "1hour": 3600,
-                "2hour": 7200,
-                "1d": 86400,
-                "1week": 604800,
-                "1mon": 2592000
-            }
-        elif self.exchange == "huobi":
-            kline_intervals = {
-                "1min": 60,
-                "5min": 300,
-                "15min": 900,
-                "30min": 1800,
-                "60min": 3600,
-                "1day": 86400,
-                "1week": 604800,
-                "1mon": 2592000
-            }
-        else:
+        if self.exchange not in EXCHANGE_KLINE_INTERVALS:
             raise Exception("Exchange not supported")
-        return kline_intervals
-    
+        # shared module level tables - not copied per instance
+        self.intervals = EXCHANGE_KLINE_INTERVALS[self.exchange]
+        self.intervals_by_seconds = EXCHANGE_KLINE_INTERVALS_BY_SECONDS[self.exchange]
+
     def get_intervals(self):
         return list(self.intervals.keys())
     
     def get_interval_seconds(self, interval: str):
         return self.intervals[interval]
+
+    def get_interval(self, seconds: int):
+        if seconds not in self.intervals_by_seconds:
+            raise Exception("Interval not supported")
+        return self.intervals_by_seconds[seconds]
     
 class ErrorCodes():
     """
@@ -164,6 +197,25 @@ class ErrorCodes():
     def get_error_code(self, error_name: str):
         return self.error_codes[error_name]
 
+@functools.lru_cache(maxsize=8)
+def get_kline_intervals(exchange: str):
+    """Returns the KlineIntervals for exchange, shared rather than rebuilt by every caller"""
+    return KlineIntervals(exchange)
+
+@functools.lru_cache(maxsize=8)
+def get_error_codes(exchange: str):
+    """Returns the ErrorCodes for exchange, shared rather than rebuilt by every caller"""
+    return ErrorCodes(exchange)
+
+_CANDLE_ORDER = operator.itemgetter(0, 6, 1, 2, 3, 4, 5)
+
+def reorder_candle(candle: list):
+    """
+    Moves the element at index 6 of a kucoin/binance candle (kucoin turnover, binance close_time) to
+    index 1 for the csv, as one C level itemgetter call rather than seven indexing statements
+    """
+    return list(_CANDLE_ORDER(candle))
+
 class HistoricalKlines:
     """
     Gets historical klines for input symbol
@@ -174,23 +226,37 @@ class HistoricalKlines:
         # convert interval to exchange specific interval
         self.interval = self._get_exchange_interval(interval_seconds)
         self.interface = interface
-        self.store = DataStore(self.exchange, self.symbol, metric="klines", csv_name="data/{exchange}/kline_history/{symbol}_{interval}.csv".format(exchange=self.exchange, symbol=self.symbol, interval=self.interval))
-        self.error_codes = ErrorCodes(self.exchange)
+        # history is stored as parquet, written as one batch per request rather than row by row
+        self.store = DataStore(self.exchange, self.symbol, metric="klines", csv_name="data/{exchange}/kline_history/{symbol}_{interval}.parquet".format(exchange=self.exchange, symbol=self.symbol, interval=self.interval),
+                               flush_threshold=KLINE_HISTORY_LIMIT, flush_interval=float("inf"), file_format="parquet", columns=self._get_kline_columns())
+        self.error_codes = get_error_codes(self.exchange)
 
     def _get_exchange_interval(self, interval_seconds: int):
-        kline_intervals = KlineIntervals(self.exchange)
-        for interval, seconds in kline_intervals.intervals.items():
-            if seconds == interval_seconds:
-                return interval
-        raise Exception("Interval not supported")
+        return get_kline_intervals(self.exchange).get_interval(interval_seconds)
     
-    def _format_klines(self, data):
-        if type(data) is dict:
-            # is a dict in form {id (unix time), open, close, low, high, amount, vol, count}
-            #print(candles)
-            return [data["id"], data["open"], data["close"], data["high"], data["low"], data["vol"], data["amount"]]
-        # is a list in form [start_time, end_time, open_price, close_price, high_price, low_price, volume]
-        return [data[0], data[6], data[1], data[2], data[3], data[4], data[5]]
+    def _get_kline_columns(self):
+        # column names for the rows returned by _format_klines
+        if self.exchange == "huobi":
+            return ["id", "open", "close", "high", "low", "vol", "amount"]
+        if self.exchange == "kucoin":
+            return ["time", "turnover", "open", "close", "high", "low", "volume"]
+        return ["open_time", "close_time", "open", "high", "low", "close", "volume"]
+
+    def _format_dict_kline(self, data: dict):
+        # is a dict in form {id (unix time), open, close, low, high, amount, vol, count}
+        return [data["id"], data["open"], data["close"], data["high"], data["low"], data["vol"], data["amount"]]
+
+    def _format_list_kline(self, data: list):
+        # kucoin: [time, open, close, high, low, volume, turnover]
+        # binance: [open_time, open, high, low, close, volume, close_time, ...]
+        return reorder_candle(data)
+
+    def _format_klines(self, candles: list):
+        # every candle in a response has the same form, so the formatter is picked once per batch
+        if len(candles) == 0:
+            return []
+        format_kline = self._format_dict_kline if type(candles[0]) is dict else self._format_list_kline
+        return list(map(format_kline, candles))
 
     def _store_klines(self, klines):
         try:
@@ -199,20 +265,16 @@ class HistoricalKlines:
             else:
                 candles = klines
             
-            for candle in candles:
-                candle = self._format_klines(candle)
-                self.store.write_data_to_csv(candle, id_index=0)
+            rows = clean_klines(self._format_klines(candles))
+            self.store.write_rows_to_csv(rows, id_index=0)
             return
         except Exception as e:
             self._error_handler(e)
     
     def _error_handler(self, error):
         if type(error) is dict:
-            if (error["code"] == self.error_codes.get_error_code("TOO_MANY_REQUESTS")):
-                print("Too many requests, sleeping for {DELAY_AFTER_TIMEOUT}  seconds")
-                time.sleep(DELAY_AFTER_TIMEOUT)
-                self.save_klines()
-            elif (error["code"] == self.error_codes.get_error_code("TIMEOUT")):
+            # requests are paced by each interface's TokenBucket, so only timeouts are retried
+            if (error["code"] == self.error_codes.get_error_code("TIMEOUT")):
                 print("Timeout, sleeping for {DELAY_AFTER_TIMEOUT}  seconds")
                 time.sleep(DELAY_AFTER_TIMEOUT)
                 self.save_klines()
@@ -225,13 +287,53 @@ class HistoricalKlines:
 
     def save_klines(self):
         print("Getting klines for {symbol} on {exchange} with interval {interval}".format(symbol=self.symbol, exchange=self.exchange, interval=self.interval))
-        klines = self.interface.get_kline_history(self.symbol, self.interval, 1000)
-        self._store_klines(klines)
+        try:
+            klines = self._get_klines()
+            self._store_klines(klines)
+        finally:
+            self.store.close()
+
+    def _get_klines(self):
+        # the session's own retries of a 429 are quick and bypass the interface's TokenBucket - once they run out,
+        # back off and make the request again through the interface, so it waits for a token like any other request
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return self.interface.get_kline_history(self.symbol, self.interval, KLINE_HISTORY_LIMIT)
+            except requests.exceptions.RetryError:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = DELAY_AFTER_RATE_LIMIT * 2 ** attempt
+                print(f"Rate limited getting klines for {self.symbol} on {self.exchange}, retrying in {delay} seconds")
+                time.sleep(delay)
+
+    async def save_klines_async(self, session, rate_controller: RateController = None):
+        """
+        Same as save_klines, but awaits the request on a shared aiohttp session
+        so many symbols can be fetched from one event loop
+        """
+        print("Getting klines for {symbol} on {exchange} with interval {interval}".format(symbol=self.symbol, exchange=self.exchange, interval=self.interval))
+        try:
+            klines = await self._get_klines_async(session, rate_controller)
+            self._store_klines(klines)
+        finally:
+            self.store.close()
+
+    async def _get_klines_async(self, session, rate_controller: RateController = None):
+        # a rate limited request is retried after backing off, rather than losing the symbol's history
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return await self.interface.get_kline_history_async(session, self.symbol, self.interval, KLINE_HISTORY_LIMIT, rate_controller)
+            except RateLimitedError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                delay = (e.retry_after or DELAY_AFTER_RATE_LIMIT) * 2 ** attempt
+                print(f"Rate limited getting klines for {self.symbol} on {self.exchange}, retrying in {delay} seconds")
+                await asyncio.sleep(delay)
 
 
 # Threading classes
 class ThreadingBase(threading.Thread):
-    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval_seconds: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None):
+    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval_seconds: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None, api: Interface = None):
         threading.Thread.__init__(self)
         self.thread_id = thread_id
         self.name = name
@@ -253,36 +355,30 @@ class ThreadingBase(threading.Thread):
         if self.duration is None:
             self.duration = 999999
 
+        # API shared by every thread for this exchange - passed in from setup, or the factory's shared instance
+        self.api = api
+        if self.api is None:
+            self.api = APIFactory(self.exchange).get_api()
+
         self.start_time = time.time()
         self._stop_event = threading.Event()
-    
-    def _get_api(self):
-        api_factory = APIFactory(self.exchange)
-        return api_factory.get_api()
+        self._timer = None # stops the thread once duration has passed - started in run
     
     def _timeout_cb(self):
-        current_duration = time.time() - self.start_time
-        if current_duration > self.duration:
-            print(f"{self.name} - Timeout reached")
-            return True
-        else:
-            return False
+        print(f"{self.name} - Timeout reached")
+        self.stop()
     
     def _get_kline_interval_from_seconds(self, seconds: int):
-        kline_intervals = KlineIntervals(self.exchange)
-        for interval, interval_seconds in kline_intervals.intervals.items():
-            if interval_seconds == seconds:
-                return interval
-        raise Exception("Interval not supported")
+        return get_kline_intervals(self.exchange).get_interval(seconds)
     
     def _check_kl_interval(self):
         # check if kline interval is valid
-        kline_intervals = KlineIntervals(self.exchange)
-        if self.kl_interval not in kline_intervals.get_intervals():
+        kline_intervals = get_kline_intervals(self.exchange)
+        if self.kl_interval not in kline_intervals.intervals:
             raise Exception(f"Invalid kline interval {self.kl_interval}")
         
     def _get_kl_interval_seconds(self):
-        kline_intervals = KlineIntervals(self.exchange)
+        kline_intervals = get_kline_intervals(self.exchange)
         return kline_intervals.get_interval_seconds(self.kl_interval)
         
     def stop(self):
@@ -292,131 +388,201 @@ class ThreadingBase(threading.Thread):
         return self._stop_event.is_set()
     
     def run(self):
+        self.start_collection()
+        self.collection_loop()
+        self.finish_collection()
+    
+    def start_collection(self):
         print(f"Starting {self.name}")
         self.start_time = time.time()
-        self.collection_loop()
+        # one timer per thread instead of checking the clock on every tick.
+        # It is not cancelled when collection_loop returns, as subscription callbacks can outlive it
+        self._timer = threading.Timer(self.duration, self._timeout_cb)
+        self._timer.daemon = True
+        self._timer.start()
+    
+    def finish_collection(self):
+        self.data_store.flush() # write out rows still buffered below the flush threshold
         print(f"Exiting {self.name}")
-        self.stop()
     
     def collection_loop(self):
         raise Exception("Not implemented")
 
+class PollingThreadBase(ThreadingBase):
+    """
+    Collector that repeats a one-off request every poll_interval seconds rather than holding a subscription.
+    poll_collectors runs many of these from one scheduler, so they do not need a thread each
+    """
+    def poll(self):
+        raise Exception("Not implemented")
+    
+    @property
+    def poll_interval(self):
+        return self.sleep
+    
+    def collection_loop(self):
+        # waiting on the stop event rather than sleeping returns as soon as the timer stops the thread
+        while (not self.stopped()):
+            self.poll()
+            self._stop_event.wait(self.poll_interval)
+
 # -------------------- HB data collection threads --------------------
-class HBTradingDataCollectionThread(ThreadingBase):
-    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None):
-        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration)
+class HBTradingDataCollectionThread(PollingThreadBase):
+    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None, api: Interface = None):
+        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration, api)
     
     def trading_data_callback(self, trade_data: TradeDetailReq):
+        if self.stopped():
+            return
         #self.data_store.store_data(trade_data)
         trade_list = trade_data.data
-        data = []
-        for trade in trade_list:
-            print(f"{self.name} - {trade.tradeId} - {trade.price} - {trade.amount} - {trade.direction} - {trade.ts}")
-            try:
-                self.data_store.write_data_to_csv([trade.tradeId, trade.price, trade.amount, trade.direction, trade.ts], id_index=0)
-            except Exception as e:
-                print(f"{self.name} - {e}")
-        
-        if (self._timeout_cb()):
-            self.stop()
+        if logger.isEnabledFor(logging.DEBUG):
+            for trade in trade_list:
+                logger.debug("%s - %s - %s - %s - %s - %s", self.name, trade.tradeId, trade.price, trade.amount, trade.direction, trade.ts)
+        try:
+            self.data_store.write_trades_to_csv((trade.tradeId, trade.price, trade.amount, trade.direction, trade.ts) for trade in trade_list)
+        except Exception as e:
+            print(f"{self.name} - {e}")
     
-    def collection_loop(self):
-        api = self._get_api()
-        api.request_trades(self.symbol, self.trading_data_callback)
-        while (not self._timeout_cb()):
-            time.sleep(self.sleep)
-            api.request_trades(self.symbol, self.trading_data_callback)
+    def poll(self):
+        # request_trades is a one-off request for recent trades, not a subscription, so it is repeated every self.sleep seconds
+        self.api.request_trades(self.symbol, self.trading_data_callback)
             
 
 class HBKlineDataCollectionThread(ThreadingBase):
-    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None):
-        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration)
+    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None, api: Interface = None):
+        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration, api)
     
     def kline_data_callback(self, kline_data: CandlestickEvent):
+        if self.stopped():
+            return
         #self.data_store.store_data(kline_data)
         kline_tick = kline_data.tick # Candlestick object
         try:
             self.data_store.write_data_to_csv([kline_tick.id, kline_tick.amount, kline_tick.close, kline_tick.count, kline_tick.high, kline_tick.low, kline_tick.open, kline_tick.vol], id_index=0)
         except Exception as e:
             print(f"{self.name} - {e}")
-        
-        if (self._timeout_cb()):
-            self.stop()
     
     def collection_loop(self):
-        api = self._get_api()
-        api.subscribe_to_candlestick(self.symbol, interval=self.kl_interval, callback_func=self.kline_data_callback)
-        #while (not self._timeout_cb()):
+        self.api.subscribe_to_candlestick(self.symbol, interval=self.kl_interval, callback_func=self.kline_data_callback)
+        #while (not self.stopped()):
         #    time.sleep(self.interval)
 
 
 # -------------------- KUCOIN data collection threads --------------------
 class KCKlineDataCollectionThread(ThreadingBase):
-    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None):
-        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration)
+    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None, api: Interface = None):
+        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration, api)
     
-    def _process_data(self, candles: list):
-        start_time = candles[0]
-        end_time = candles[6]
-        open_price = candles[1]
-        close_price = candles[2]
-        high_price = candles[3]
-        low_price = candles[4]
-        volume = candles[5]
-        return [start_time, end_time, open_price, close_price, high_price, low_price, volume]
-
-    def kline_data_callback(self, kline_data: dict):
+    async def kline_data_callback(self, kline_data: dict): # kucoin ws client awaits its callback
+        if self.stopped():
+            return
         kline_tick = kline_data["data"]
         candles = kline_tick["candles"]
         try:
-            self.data_store.write_data_to_csv(self._process_data(candles), id_index=0)
+            await self.data_store.awrite_data_to_csv(reorder_candle(candles), id_index=0)
         except Exception as e:
             print(f"{self.name} - {e}")
-        
-        if (self._timeout_cb()):
-            self.stop()
     
     def collection_loop(self):
-        api = self._get_api()
-        api.subscribe_to_candlestick(self.symbol, interval=self.kl_interval, callback_func=self.kline_data_callback, duration=self.duration) # needs additional duration parameter
-        #while (not self._timeout_cb()):
+        self.api.subscribe_to_candlestick(self.symbol, interval=self.kl_interval, callback_func=self.kline_data_callback, duration=self.duration) # needs additional duration parameter
+    
+    def finish_collection(self):
+        # the callbacks wrote through the store's async handle on the kucoin ws loop, so it is closed there
+        # rather than by flush, which would open a second, sync handle on the same csv
+        self.api.run_on_ws_loop(self.data_store.aclose())
+        print(f"Exiting {self.name}")
+        #while (not self.stopped()):
         #    time.sleep(self.interval)
 
 # -------------------- BINANCE data collection threads --------------------
-class BNCandlestickDataCollectionThread(ThreadingBase):
-    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None):
-        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration)
+class BNCandlestickDataCollectionThread(PollingThreadBase):
+    def __init__(self, thread_id: str, name: str, exchange: str, symbol: str, metric: str, kl_interval: int = None, sleep: int = None, data_store: DataStore = None, duration: int = None, api: Interface = None):
+        ThreadingBase.__init__(self, thread_id, name, exchange, symbol, metric, kl_interval, sleep, data_store, duration, api)
     
-    def _process_data(self, candles: list):
-        start_time = candles[0]
-        end_time = candles[6]
-        open_price = candles[1]
-        close_price = candles[2]
-        high_price = candles[3]
-        low_price = candles[4]
-        volume = candles[5]
-        return [start_time, end_time, open_price, close_price, high_price, low_price, volume]
-
     def kline_data_callback(self, _, kline_data: dict): # has extra parameter
+        if self.stopped():
+            return
         # enforce dict type - bn api returns string
         if (type(kline_data) == str):
-            kline_data = json.loads(kline_data)
+            kline_data = orjson.loads(kline_data)
         kline_tick = kline_data["result"][0]
         try:
-            self.data_store.write_data_to_csv(self._process_data(kline_tick), id_index=0)
+            self.data_store.write_data_to_csv(reorder_candle(kline_tick), id_index=0)
         except Exception as e:
             print(f"{self.name} - {e}")
-        
-        if (self._timeout_cb()):
-            self.stop()
     
-    def collection_loop(self):
-        api = self._get_api()
-        while (not self._timeout_cb()):
-            api.subscribe_to_candlestick(self.symbol, interval=self.kl_interval, callback_func=self.kline_data_callback)
-            time.sleep(self.kl_interval_seconds)
+    @property
+    def poll_interval(self):
+        return self.kl_interval_seconds
+    
+    def poll(self):
+        self.api.subscribe_to_candlestick(self.symbol, interval=self.kl_interval, callback_func=self.kline_data_callback)
 
 # ---------------------------- FUNCTIONS ----------------------------
+def create_collectors(thread_cls, exchange: str, symbols: list, metric: str, duration: int = DURATION, api: Interface = None):
+    """
+    Create a collection thread of type thread_cls for each symbol
+    """
+    collectors = []
+    for symbol in symbols:
+        collectors.append(thread_cls(thread_id="temp", name=f"{symbol}_{metric}", exchange=exchange, symbol=symbol, metric=metric, kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=duration, api=api))
+    return collectors
+
+def collect(thread_cls, exchange: str, symbols: list, metric: str, duration: int = DURATION, max_workers: int = None, api: Interface = None):
+    """
+    Create a collection thread of type thread_cls for each symbol, run them all and wait for them to finish
+    """
+    print(f"Creating {exchange} {metric} collectors for {len(symbols)} symbols")
+    collectors = create_collectors(thread_cls, exchange, symbols, metric, duration, api)
+    if issubclass(thread_cls, PollingThreadBase):
+        poll_collectors(collectors, max_workers or SIMULTANEOUS_REQUESTS)
+    else:
+        run_collectors(collectors, max_workers)
+
+def create_data_dirs(exchange: str, metrics: tuple = ("klines", "trades", "kline_history")):
+    """
+    Create the data folders for an exchange once, so each DataStore can open its csv directly
+    """
+    for metric in metrics:
+        os.makedirs(f"data/{exchange}/{metric}", exist_ok=True)
+
+def run_collectors(collectors: list, max_workers: int = None):
+    """
+    Runs each collector's collection loop on a thread pool and waits for all of them.
+    By default every collector gets a worker, as subscription collectors block until their duration is up.
+    Polling collectors should go through poll_collectors instead
+    """
+    if max_workers is None:
+        max_workers = max(1, len(collectors))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda collector: collector.run(), collectors))
+
+def poll_collectors(collectors: list, max_workers: int = SIMULTANEOUS_REQUESTS):
+    """
+    Runs polling collectors from one scheduler, which hands each collector's poll to a pool of max_workers threads when it is due.
+    At most max_workers requests are in flight however many symbols are tracked,
+    and a collector whose last poll has not returned yet is skipped rather than queued twice
+    """
+    schedule = [(time.monotonic(), i) for i in range(len(collectors))] # (next poll time, collector index) min heap
+    in_flight = {}
+    for collector in collectors:
+        collector.start_collection()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while schedule:
+            due, i = heapq.heappop(schedule)
+            collector = collectors[i]
+            delay = due - time.monotonic()
+            if delay > 0:
+                collector._stop_event.wait(delay)
+            if collector.stopped():
+                continue
+            if i not in in_flight or in_flight[i].done():
+                in_flight[i] = executor.submit(collector.poll)
+            heapq.heappush(schedule, (due + collector.poll_interval, i))
+    for collector in collectors:
+        collector.finish_collection()
+
 
 # ---------------------------- BINANCE ----------------------------
 def binance_setup():
@@ -429,36 +595,23 @@ def binance_setup():
     # get coins that are online and not excluded
     binance_symbols = binance_api.get_symbols()
     bn_symbols = binance_set_coins_to_track(binance_symbols, binance_symbols_manager)
+    create_data_dirs("binance")
     return binance_api, bn_symbols
 
 def binance_set_coins_to_track(bn_symbols: list, bn_symbols_manager: SymbolsManagerBase):
     """
     Returns list of coins to track
     """
-    bn_symbols_df = bn_symbols_manager.convert_to_dataframe(bn_symbols)
-    #bn_symbols_included = bn_symbols_manager.convert_to_list(bn_symbols_manager.filter_excluded(bn_symbols_df))
-    bn_symbols_online = bn_symbols_manager.convert_to_list(bn_symbols_manager.filter_offline(bn_symbols_df))
-    #bn_symbols = list(set(bn_symbols_included) & set(bn_symbols_online))
-    bn_symbols = bn_symbols_online
+    bn_symbols = bn_symbols_manager.pick_tradable(bn_symbols, EXCLUDED_COINS)
     # temp set to BTC AND ETH
     #bn_symbols = ["BTCUSDT", "ETHUSDT"]
     return bn_symbols
 
-def binance_get_klines(bn_api, bn_symbols: str):
+def binance_get_klines(bn_api, bn_symbols: list):
     """
     Create threads to get kline data for each symbol
     """
-    threads = []
-    for symbol in bn_symbols:
-        bn_thread = BNCandlestickDataCollectionThread(thread_id=f"BN_{symbol}", name=f"BN_{symbol}", exchange="binance", symbol=symbol, metric="klines", kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=60)
-        threads.append(bn_thread)
-    
-    for thread in threads:
-        thread.start()
-    
-    for thread in threads:
-        thread.join()
-
+    collect(BNCandlestickDataCollectionThread, "binance", bn_symbols, "klines", duration=60, api=bn_api)
 
 # ---------------------------- KUCOIN ----------------------------
 def kucoin_setup():
@@ -471,16 +624,14 @@ def kucoin_setup():
     # get coins that are online and not excluded
     kucoin_symbols = kucoin_api.get_symbols()
     kc_symbols = kucoin_set_coins_to_track(kucoin_symbols, kucoin_symbols_manager)
+    create_data_dirs("kucoin")
     return kucoin_api, kc_symbols
 
 def kucoin_set_coins_to_track(kc_symbols: list, kc_symbols_manager: SymbolsManagerBase):
     """
     Returns list of coins to track
     """
-    kc_symbols_df = kc_symbols_manager.convert_to_dataframe(kc_symbols)
-    kc_symbols_included = kc_symbols_manager.filter_excluded(kc_symbols_df)
-    kc_symbols_online = kc_symbols_manager.filter_offline(kc_symbols_df)
-    kc_symbols = list(set(kc_symbols_included) & set(kc_symbols_online))
+    kc_symbols = kc_symbols_manager.pick_tradable(kc_symbols)
     kc_symbols = ["BTC-USDT", "ETH-USDT"]
     return kc_symbols
 
@@ -488,19 +639,7 @@ def kucoin_get_klines(kc_api, kc_symbols: list):
     """
     Create threads to get klines for each symbol
     """
-    threads = []
-    # create new threads
-    print("Creating threads")
-    for symbol in kc_symbols:
-        thread = KCKlineDataCollectionThread(thread_id="temp", name=f"{symbol}_klines", exchange="kucoin", symbol=symbol, metric="klines", kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=DURATION)
-        threads.append(thread)
-        print(f"Created thread for {symbol}")
-    # start new threads
-    for t in threads:
-        t.start()
-    # wait for all threads to complete
-    for t in threads:
-        t.join()
+    collect(KCKlineDataCollectionThread, "kucoin", kc_symbols, "klines", api=kc_api)
 
 
 # ---------------------------- HUOBI ----------------------------
@@ -514,78 +653,104 @@ def huobi_setup():
     # get coins that are online and not excluded
     huobi_symbols = huobi_api.get_symbols()
     hb_symbols = huobi_set_coins_to_track(huobi_symbols, huobi_symbols_manager)
+    create_data_dirs("huobi")
     return huobi_api, hb_symbols
 
 def huobi_set_coins_to_track(hb_symbols: list, hb_symbols_manager: SymbolsManagerBase):
     """
     Returns list of coins to track
     """
-    hb_symbols_df = hb_symbols_manager.convert_to_dataframe(hb_symbols)
-    hb_symbols_excluded = hb_symbols_manager.filter_excluded(hb_symbols_df, EXCLUDED_COINS)
-    hb_symbols_offline = hb_symbols_manager.filter_offline(hb_symbols_df)
-    hb_symbols = list(set(hb_symbols_excluded) & set(hb_symbols_offline))
+    hb_symbols = hb_symbols_manager.pick_tradable(hb_symbols, EXCLUDED_COINS)
     hb_symbols = ["btcusdt", "ethusdt"]
     return hb_symbols
 
 def huobi_staggered_get_trades(hb_api, hb_symbols):
-    # Create threads for x symbols at a time to avoid rate limit
-    threads = []
-    for i in range(0, len(hb_symbols), SIMULTANEOUS_REQUESTS):
-        threads.append(threading.Thread(target=huobi_get_trades, args=(hb_api, hb_symbols[i:i+SIMULTANEOUS_REQUESTS])))
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
-        threads = []
-        time.sleep(SLEEP_BETWEEN_THREAD_GEN)
+    """
+    Collect trades for every symbol on one event loop,
+    connecting at most SIMULTANEOUS_REQUESTS symbols at a time to avoid rate limit
+    """
+    run_async(huobi_stream_trades(hb_api, hb_symbols))
+
+async def huobi_stream_trades(hb_api, hb_symbols):
+    semaphore = asyncio.Semaphore(SIMULTANEOUS_REQUESTS)
+
+    async def collect_symbol(symbol):
+        async with DataStore("huobi", symbol, "trades") as data_store:
+            async def trading_data_callback(trades: list):
+                rows = [[trade["tradeId"], trade["price"], trade["amount"], trade["direction"], trade["ts"]] for trade in trades]
+                await data_store.awrite_rows_to_csv(rows, id_index=0)
+
+            print(f"Collecting trades for {symbol}")
+            try:
+                await hb_api.stream_trades(symbol, trading_data_callback, DURATION, semaphore)
+            except Exception as e:
+                print(f"{symbol}_trades - {e}")
+
+    await asyncio.gather(*[collect_symbol(symbol) for symbol in hb_symbols])
 
 def huobi_get_trades(hb_api, hb_symbols):
     """
     Create threads for each symbol and start collecting trades
     """
-    threads = []
-    # create new threads
-    print("Creating threads")
-    for symbol in hb_symbols:
-        thread = HBTradingDataCollectionThread(thread_id="temp", name=f"{symbol}_trades", exchange="huobi", symbol=symbol, metric="trades", kl_interval=KLINE_INTERVAL, sleep=INTERVAL, duration=DURATION)
-        threads.append(thread)
-        print(f"Created thread for {symbol}")
-    # start new threads
-    for t in threads:
-        t.start()
-    # wait for all threads to complete
-    for t in threads:
-        t.join()
+    collect(HBTradingDataCollectionThread, "huobi", hb_symbols, "trades", api=hb_api)
 
 def huobi_staggered_get_klines(hb_api, hb_symbols):
-    # Create threads for x symbols at a time to avoid rate limit
-    threads = []
-    for i in range(0, len(hb_symbols), SIMULTANEOUS_REQUESTS):
-        threads.append(threading.Thread(target=huobi_get_klines, args=(hb_api, hb_symbols[i:i+SIMULTANEOUS_REQUESTS])))
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
-        threads = []
-        time.sleep(SLEEP_BETWEEN_THREAD_GEN)
-
-def huobi_get_klines(hb_api, hb_symbols):
+    """
+    Collect klines for every symbol on one event loop,
+    connecting at most SIMULTANEOUS_REQUESTS symbols at a time to avoid rate limit
+    """
+    run_async(huobi_stream_klines(hb_api, hb_symbols))
+
+async def huobi_stream_klines(hb_api, hb_symbols):
+    semaphore = asyncio.Semaphore(SIMULTANEOUS_REQUESTS)
+    interval = get_kline_intervals("huobi").get_interval(KLINE_INTERVAL_SECONDS)
+
+    async def collect_symbol(symbol):
+        async with DataStore("huobi", symbol, "klines") as data_store:
+            async def kline_data_callback(kline: dict):
+                # same columns as HBKlineDataCollectionThread
+                row = [kline["id"], kline["amount"], kline["close"], kline["count"], kline["high"], kline["low"], kline["open"], kline["vol"]]
+                await data_store.awrite_data_to_csv(row, id_index=0)
+
+            print(f"Collecting klines for {symbol}")
+            try:
+                await hb_api.stream_klines(symbol, interval, kline_data_callback, DURATION, semaphore)
+            except Exception as e:
+                print(f"{symbol}_klines - {e}")
+
+    await asyncio.gather(*[collect_symbol(symbol) for symbol in hb_symbols])
+
+def huobi_get_klines(hb_api, hb_symbols, max_workers: int = None):
     """
     Create threads for each symbol and start collecting klines
     """
-    threads = []
-    # create new threads
-    print("Creating threads")
-    for symbol in hb_symbols:
-        thread = HBKlineDataCollectionThread(thread_id="temp", name=f"{symbol}_klines", exchange="huobi", symbol=symbol, metric="klines", kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=DURATION)
-        threads.append(thread)
-        print(f"Created thread for {symbol}")
-    # start new threads
-    for t in threads:
-        t.start()
-    # wait for all threads to complete
-    for t in threads:
-        t.join()
+    collect(HBKlineDataCollectionThread, "huobi", hb_symbols, "klines", max_workers=max_workers, api=hb_api)
+
+# ---------------------------- HISTORY ----------------------------
+async def get_kline_history(exchange: str, api: Interface, symbols: list):
+    """
+    Fetch kline history for every symbol as tasks on one event loop,
+    starting with SIMULTANEOUS_REQUESTS requests in flight and adapting to the exchange's rate limits.
+    Requests are also paced by the interface's TokenBucket
+    """
+    rate_controller = RateController(SIMULTANEOUS_REQUESTS)
+
+    async def fetch(session, symbol):
+        # a failed symbol is reported and skipped, so it can't cancel the other symbols' requests
+        try:
+            async with rate_controller:
+                await HistoricalKlines(exchange, symbol, KLINE_INTERVAL_SECONDS, api).save_klines_async(session, rate_controller)
+        except Exception as e:
+            print(f"{exchange}_{symbol}_kline_history - {e!r}")
+
+    async with create_async_session() as session:
+        await asyncio.gather(*[fetch(session, symbol) for symbol in symbols])
+
+async def get_kline_history_exchanges(exchanges: list):
+    """
+    Fetch kline history for several exchanges at once - exchanges is a list of (exchange, api, symbols)
+    """
+    await asyncio.gather(*[get_kline_history(exchange, api, symbols) for exchange, api, symbols in exchanges])
 
 
 # ---------------------------- MAIN ----------------------------
@@ -614,16 +779,12 @@ def get_historical_all():
     bn_api, bn_symbols = binance_setup()
 
     print("Getting historical klines")
-    # Get max historical klines for each exchange
-    #for symbol in huobi_symbols:
-    #    HistoricalKlines("huobi", symbol, KLINE_INTERVAL_SECONDS, huobi_api).save_klines()
-    #    time.sleep(SLEEP_BETWEEN_HISTORY_REQUESTS)
-    for symbol in kc_symbols:
-        HistoricalKlines("kucoin", symbol, KLINE_INTERVAL_SECONDS, kc_api).save_klines()
-        time.sleep(SLEEP_BETWEEN_HISTORY_REQUESTS)
-    #for symbol in bn_symbols:
-    #    HistoricalKlines("binance", symbol, KLINE_INTERVAL_SECONDS, bn_api).save_klines()
-    #    time.sleep(SLEEP_BETWEEN_HISTORY_REQUESTS)
+    # Get max historical klines for each exchange, all exchanges and symbols concurrently
+    run_async(get_kline_history_exchanges([
+        #("huobi", huobi_api, huobi_symbols),
+        ("kucoin", kc_api, kc_symbols),
+        #("binance", bn_api, bn_symbols),
+    ]))
 
 def all_threads():
     # Setup
@@ -631,32 +792,36 @@ def all_threads():
     kc_api, kc_symbols = kucoin_setup()
     bn_api, bn_symbols = binance_setup()
     
-    print("Starting threads")
-    # Create threads
-    threads = []
-    # Huobi
-    for symbol in huobi_symbols:
-        thread = HBKlineDataCollectionThread(thread_id="temp", name=f"{symbol}_klines", exchange="huobi", symbol=symbol, metric="klines", kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=DURATION)
-        threads.append(thread)
-    # Kucoin
-    for symbol in kc_symbols:
-        thread = KCKlineDataCollectionThread(thread_id="temp", name=f"{symbol}_klines", exchange="kucoin", symbol=symbol, metric="klines", kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=DURATION)
-        threads.append(thread)
-    # Binance
-    for symbol in bn_symbols:
-        thread = BNCandlestickDataCollectionThread(thread_id="temp", name=f"{symbol}_klines", exchange="binance", symbol=symbol, metric="klines", kl_interval=KLINE_INTERVAL_SECONDS, sleep=INTERVAL, duration=DURATION)
-        threads.append(thread)
-    
-    # Start threads - staggered
-    for i in range(0, len(threads), SIMULTANEOUS_REQUESTS):
-        for t in threads[i:i+SIMULTANEOUS_REQUESTS]:
-            t.start()
-        for t in threads[i:i+SIMULTANEOUS_REQUESTS]:
-            t.join()
-        time.sleep(SLEEP_BETWEEN_THREAD_GEN)
-
+    print("Starting collectors")
+    # Huobi klines are tasks on one event loop, connecting SIMULTANEOUS_REQUESTS symbols at a time (see huobi_stream_klines).
+    # Kucoin symbols share one SDK connection, so their collectors all start together.
+    # Binance klines are polled, so they share one scheduler and SIMULTANEOUS_REQUESTS workers (see poll_collectors)
+    kc_threads = create_collectors(KCKlineDataCollectionThread, "kucoin", kc_symbols, "klines", api=kc_api)
+    bn_threads = create_collectors(BNCandlestickDataCollectionThread, "binance", bn_symbols, "klines", api=bn_api)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(huobi_staggered_get_klines, huobi_api, huobi_symbols), executor.submit(run_collectors, kc_threads), executor.submit(poll_collectors, bn_threads)]
+        for future in futures:
+            future.result()
+
+
+def setup_logging(level: int = LOG_LEVEL):
+    """
+    Route log records through a queue, so collection threads only enqueue them
+    and a single background listener thread writes them to stderr
+    """
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop) # write out any queued records on exit
+    return listener
 
 def main():
+    setup_logging()
     #run_kc_threads()
     #run_hb_threads()
     #run_bn_threads()
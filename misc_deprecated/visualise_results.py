@@ -1,17 +1,27 @@
 # general imports
-import matplotlib.pyplot as plt
-import csv
 import os
-import datetime
+import re
+import functools
+import operator
+import numpy as np # (https://numpy.org/)
+import numba # (https://numba.pydata.org/)
 import pandas as pd
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 # pyqt imports
 import PyQt5.QtCore as QtCore
 import PyQt5.QtGui as QtGui
 import PyQt5.QtWidgets as QtWidgets
+import matplotlib as mpl # (https://matplotlib.org/)
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 
+# let Agg merge line segments closer than a pixel, and render long lines in chunks
+mpl.rcParams["path.simplify"] = True
+mpl.rcParams["path.simplify_threshold"] = 1.0
+mpl.rcParams["agg.path.chunksize"] = 10000
+
 # ------------------------------------------------------------------
 # Functions to load data and create pyplot figures
 # ------------------------------------------------------------------
@@ -20,112 +30,255 @@ from matplotlib.figure import Figure
 PATH_TO_DATA = "data/"
 EXCHANGES_LIST = ["huobi"]
 #EXCHANGE_METRICS = ["avg_price", "avg_quantity", "avg_volume"]
+MAX_PLOTTED_TRADES = 10_000 # trade lines with more points than this are downsampled before plotting
+SUMMARY_COLUMNS = ["symbol", "avg_price", "avg_quantity", "total_volume", "mtime_ns"]
+SYMBOL_FROM_CSV_NAME = re.compile(r"^[^_]*_([^_.]*)") # "{exchange}_{symbol}_trades.csv" -> symbol
+
+# bytes used by the huobi trade parser
+_OPEN_BRACKET, _CLOSE_BRACKET, _MINUS, _PLUS, _DOT, _QUOTE = ord("["), ord("]"), ord("-"), ord("+"), ord("."), ord("'")
+_ZERO, _NINE, _LOWER_E, _UPPER_E, _LOWER_B = ord("0"), ord("9"), ord("e"), ord("E"), ord("b")
+
+# ---------------------------- NUMBA FUNCTIONS ----------------------------
+@numba.njit(cache=True)
+def _parse_number(buf, i, end):
+    """Parses the int/float starting at or after buf[i], returning (value, index after it). Handles sign, fraction and exponent."""
+    while i < end and (buf[i] < _ZERO or buf[i] > _NINE) and buf[i] != _MINUS and buf[i] != _DOT:
+        i += 1
+    sign = 1.0
+    if i < end and buf[i] == _MINUS:
+        sign = -1.0
+        i += 1
+    # digits are accumulated as an integer mantissa and scaled once, which is exact for up to 15 significant digits
+    mantissa = 0
+    exponent = 0
+    while i < end and _ZERO <= buf[i] <= _NINE:
+        mantissa = mantissa * 10 + (buf[i] - _ZERO)
+        i += 1
+    if i < end and buf[i] == _DOT:
+        i += 1
+        while i < end and _ZERO <= buf[i] <= _NINE:
+            mantissa = mantissa * 10 + (buf[i] - _ZERO)
+            exponent -= 1
+            i += 1
+    if i < end and (buf[i] == _LOWER_E or buf[i] == _UPPER_E):
+        i += 1
+        exponent_sign = 1
+        if i < end and buf[i] == _MINUS:
+            exponent_sign = -1
+            i += 1
+        elif i < end and buf[i] == _PLUS:
+            i += 1
+        written_exponent = 0
+        while i < end and _ZERO <= buf[i] <= _NINE:
+            written_exponent = written_exponent * 10 + (buf[i] - _ZERO)
+            i += 1
+        exponent += exponent_sign * written_exponent
+    if exponent < 0:
+        return sign * (mantissa / 10.0 ** -exponent), i
+    return sign * (mantissa * 10.0 ** exponent), i
+
+@numba.njit(cache=True)
+def _parse_int(buf, i, end):
+    """Parses the non-negative integer starting at or after buf[i], returning (value, index after it)"""
+    while i < end and (buf[i] < _ZERO or buf[i] > _NINE):
+        i += 1
+    value = 0
+    while i < end and _ZERO <= buf[i] <= _NINE:
+        value = value * 10 + (buf[i] - _ZERO)
+        i += 1
+    return value, i
+
+@numba.njit(cache=True)
+def _skip_to(buf, i, end, target):
+    """Returns the index of the first target byte at or after buf[i], stopping at the start of the next trade or the end of buf"""
+    while i < end and buf[i] != target and (buf[i] != _OPEN_BRACKET or target == _OPEN_BRACKET):
+        i += 1
+    if i >= end or buf[i] != target:
+        raise ValueError("Incomplete trade record in huobi trades csv")
+    return i
+
+@numba.njit(cache=True, nogil=True)
+def parse_huobi_trades(buf):
+    """
+    Parses the raw bytes of a huobi trades csv, where each cell is a stringified trade "[tradeId, price, amount, 'direction', ts]".
+    Scans byte by byte and returns parallel arrays (ids, prices, amounts, is_sell, ts), without building any Python strings.
+    Raises ValueError if a trade record is incomplete, e.g. the last one in a csv whose collector was stopped mid-write.
+    """
+    n_trades = 0
+    for byte in buf:
+        if byte == _OPEN_BRACKET:
+            n_trades += 1
+    ids = np.empty(n_trades, dtype=np.int64)
+    prices = np.empty(n_trades, dtype=np.float64)
+    amounts = np.empty(n_trades, dtype=np.float64)
+    is_sell = np.empty(n_trades, dtype=np.bool_)
+    ts = np.empty(n_trades, dtype=np.int64)
+
+    end = len(buf)
+    i = 0
+    n = 0
+    while n < n_trades:
+        i = _skip_to(buf, i, end, _OPEN_BRACKET)
+        trade_id, i = _parse_int(buf, i + 1, end)
+        price, i = _parse_number(buf, i + 1, end)
+        amount, i = _parse_number(buf, i + 1, end)
+        # direction is 'buy' or 'sell' - only the first letter is needed
+        i = _skip_to(buf, i, end, _QUOTE)
+        if i + 1 >= end:
+            raise ValueError("Incomplete trade record in huobi trades csv")
+        sell = buf[i + 1] != _LOWER_B
+        i = _skip_to(buf, i + 1, end, _QUOTE)
+        trade_ts, i = _parse_int(buf, i + 1, end)
+        i = _skip_to(buf, i, end, _CLOSE_BRACKET)
+        # only stored once the whole record has been read
+        ids[n] = trade_id
+        prices[n] = price
+        amounts[n] = amount
+        is_sell[n] = sell
+        ts[n] = trade_ts
+        n += 1
+    return ids, prices, amounts, is_sell, ts
+
+@numba.njit(cache=True)
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of the line (x, y) to n_out points.
+    Returns the indices of the kept points - the first and last point, and from each bucket in between,
+    the point forming the largest triangle with the previously kept point and the average of the next bucket.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[n_out - 1] = n - 1
+    bucket_size = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        # average of the next bucket (just the last point, for the final bucket)
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        if next_end <= next_start:
+            next_end = next_start + 1
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        max_area = -1.0
+        kept = a
+        for j in range(int(i * bucket_size) + 1, int((i + 1) * bucket_size) + 1):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > max_area:
+                max_area = area
+                kept = j
+        indices[i + 1] = kept
+        a = kept
+    return indices
 
 # ---------------------------- CLASSES ----------------------------
+class Trades(NamedTuple):
+    """
+    Trades as parallel arrays, one element per trade, sorted by timestamp
+    """
+    ids: np.ndarray # int64
+    prices: np.ndarray # float64
+    amounts: np.ndarray # float64
+    directions: np.ndarray # "buy" or "sell"
+    ts: np.ndarray # datetime64[ms]
+
 class DataProcessing():
     """
     For each exchange, create a class to process data according to the exchange's API
     """
     def __init__(self, exchange: str):
         self.exchange = exchange
+        # bind the exchange's implementations once, instead of checking self.exchange on every call
+        if exchange == "huobi":
+            self.process_trades_from_csv = self._process_huobi_trades_from_cache
+            self.average_price = self._average_huobi_price
+            self.average_quantity = self._average_huobi_quantity
+            self.total_volume = self._total_huobi_volume
+            self.summarise = self._summarise_huobi_trades
 
     def _catch_no_data(self, data: list):
         if len(data) == 0:
             raise Exception("No data to process")
 
-    def process_trades(self, trades: list):
+    def process_trades_from_csv(self, csv_name: str):
         """
-        Process trades from exchange API
+        Process trades from the exchange's trades csv.
+        Parsed trades are cached until the csv is modified.
         """
-        if self.exchange == "huobi":
-            return self._process_huobi_trades(trades)
+        raise Exception("Exchange not supported")
+
+    def _process_huobi_trades_from_cache(self, csv_name: str):
+        return _cached_trades_from_csv(self.exchange, csv_name, os.stat(csv_name).st_mtime_ns)
+
+    def _process_huobi_trades_from_csv(self, csv_name: str):
+        # the csv is memory mapped rather than read, so its text is paged in from disk as the parser scans it
+        # instead of being copied into memory all at once. There is no padding after the mapped bytes, which is fine
+        # as parse_huobi_trades never reads past len(buf). Empty files can't be mapped.
+        if os.path.getsize(csv_name) == 0:
+            buf = np.empty(0, dtype=np.uint8)
         else:
-            raise Exception("Exchange not supported")
-    
-    def _process_huobi_trades(self, trades: list):
-        # Extract data from csv
-        self._catch_no_data(trades)
-        raw_trading_data = trades[0]
-        trades = []
-        for trade in raw_trading_data:
-            new_trade = trade.split(",")
-            # strip square brackets from first and last elements
-            new_trade[0] = new_trade[0][1:]
-            new_trade[-1] = new_trade[-1][:-1]
-            # strip whitespace from all elements
-            new_trade = [element.strip() for element in new_trade]
-            # strip quotes from all elements
-            new_trade = [element.strip('\'') for element in new_trade]
-            # convert price and quantity to floats
-            # trade.tradeId, trade.price, trade.amount, trade.direction, trade.ts
-            new_trade[1] = float(new_trade[1])
-            new_trade[2] = float(new_trade[2])
-            # convert timestamp to datetime
-            new_trade[4] = datetime.datetime.fromtimestamp(int(new_trade[4])/1000)
-            trades.append(new_trade)
-        
+            buf = np.memmap(csv_name, dtype=np.uint8, mode="r")
+        ids, prices, amounts, is_sell, ts = parse_huobi_trades(buf)
+        self._catch_no_data(ids)
         # sort trades by timestamp
-        trades.sort(key=lambda x: x[4])
+        order = np.argsort(ts, kind="stable")
+        return Trades(ids[order], prices[order], amounts[order], np.where(is_sell[order], "sell", "buy"), ts[order].view("datetime64[ms]"))
 
-        return trades
-    
-    def average_price(self, trades: list):
+    def average_price(self, trades: Trades):
         """
         Calculate average price of trades
         """
-        if self.exchange == "huobi":
-            return self._average_huobi_price(trades)
-        else:
-            raise Exception("Exchange not supported")
+        raise Exception("Exchange not supported")
     
-    def _average_huobi_price(self, trades: list):
-        total_price = 0
-        for trade in trades:
-            total_price += trade[1]
-        average_price = total_price / len(trades)
-        return average_price
+    def _average_huobi_price(self, trades: Trades):
+        return float(trades.prices.mean())
     
-    def average_quantity(self, trades: list):
+    def average_quantity(self, trades: Trades):
         """
         Calculate average quantity of trades
         """
-        if self.exchange == "huobi":
-            return self._average_huobi_quantity(trades)
-        else:
-            raise Exception("Exchange not supported")
+        raise Exception("Exchange not supported")
         
-    def _average_huobi_quantity(self, trades: list):
-        total_quantity = 0
-        for trade in trades:
-            total_quantity += trade[2]
-        average_quantity = total_quantity / len(trades)
-        return average_quantity
-
-    def total_volume(self, trades: list):
+    def _average_huobi_quantity(self, trades: Trades):
+        return float(trades.amounts.mean())
+
+    def total_volume(self, trades: Trades):
         """
         Calculate total volume of trades
         """
-        if self.exchange == "huobi":
-            return self._total_huobi_volume(trades)
-        else:
-            raise Exception("Exchange not supported")
+        raise Exception("Exchange not supported")
         
-    def _total_huobi_volume(self, trades: list):
-        total_volume = 0
-        for trade in trades:
-            total_volume += trade[2]
-        return total_volume
+    def _total_huobi_volume(self, trades: Trades):
+        return float(trades.amounts.sum())
+
+    def summarise(self, trades: Trades):
+        """
+        Calculate (average price, average quantity, total volume) of trades
+        """
+        raise Exception("Exchange not supported")
+
+    def _summarise_huobi_trades(self, trades: Trades):
+        # amounts are summed once and reused for the average, so each array is only read once
+        total_volume = float(trades.amounts.sum())
+        return float(trades.prices.mean()), total_volume / len(trades.amounts), total_volume
     
     
 
 # ---------------------------- FUNCTIONS ----------------------------
-def load_data_from_csv(csv_name):
-    data = []
-    with open(csv_name, 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            data.append(row)
-    return data
+@functools.lru_cache(maxsize=64)
+def _cached_trades_from_csv(exchange: str, csv_name: str, mtime_ns: int):
+    # mtime_ns is only part of the cache key, so a csv that has been written to since is parsed again
+    if exchange == "huobi":
+        trades = DataProcessing(exchange)._process_huobi_trades_from_csv(csv_name)
+    else:
+        raise Exception("Exchange not supported")
+    # cached arrays are shared by every caller
+    for array in trades:
+        array.flags.writeable = False
+    return trades
 
 def load_csvs_from_dir(dir_name):
     csvs = []
@@ -139,67 +292,89 @@ def get_csv_names(exchange: str):
     csv_names = load_csvs_from_dir(f"{PATH_TO_DATA}{lcase_exchange}_data/")
     return csv_names
 
-def plot_trades_from_csv(exchange: str, symbol: str):
+def load_trades_from_csv(exchange: str, symbol: str):
     lcase_exchange = exchange.lower()
     lcase_symbol = symbol.lower()
     csv_name = f"{PATH_TO_DATA}{lcase_exchange}_data/{lcase_exchange}_{lcase_symbol}_trades.csv"
-    data = load_data_from_csv(csv_name)
-
     # Extract data from csv
     data_processor = DataProcessing(lcase_exchange)
-    trades = data_processor.process_trades(data)
+    return data_processor.process_trades_from_csv(csv_name)
 
-    # Plot data
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    #ax.plot([trade[1] for trade in trades], [trade[4] for trade in trades])
-    ax.plot([trade[4] for trade in trades], [trade[1] for trade in trades])
-    ax.set_title(f"{exchange} {symbol} Trades")
-    ax.set_xlabel("Time")
-    ax.set_ylabel("Price")
-    return fig
+def downsample_trades(trades: Trades, n_out: int = MAX_PLOTTED_TRADES):
+    """
+    Returns (ts, prices) of trades, downsampled with LTTB to n_out points if there are more than that
+    """
+    if len(trades.ts) <= n_out:
+        return trades.ts, trades.prices
+    indices = lttb_indices(trades.ts.view(np.int64).astype(np.float64), trades.prices, n_out)
+    return trades.ts[indices], trades.prices[indices]
 
-def plot_overall_from_csvs(exchange: str):
+def load_exchange_summary(exchange: str):
+    """
+    Returns a DataFrame with a row [symbol (csv name), avg_price, avg_quantity, total_volume, mtime_ns] per trades csv.
+    Rows are kept in {exchange}_summary.parquet, and only csvs modified since their row was written are parsed again.
+    """
     lcase_exchange = exchange.lower()
-    csv_names = get_csv_names(exchange)
-    fig = plt.figure()
-    ax1 = fig.add_subplot(111)
+    data_dir = f"{PATH_TO_DATA}{lcase_exchange}_data/"
+    summary_path = f"{data_dir}{lcase_exchange}_summary.parquet"
+    csv_mtimes = {csv_name: os.stat(f"{data_dir}{csv_name}").st_mtime_ns for csv_name in get_csv_names(exchange)}
+    try:
+        saved_summary_df = pd.read_parquet(summary_path)
+    except FileNotFoundError:
+        saved_summary_df = pd.DataFrame(columns=SUMMARY_COLUMNS)
+
+    # keep rows whose csv is unchanged
+    summary_df = saved_summary_df[saved_summary_df["symbol"].map(csv_mtimes) == saved_summary_df["mtime_ns"]]
+    summarised_csv_names = set(summary_df["symbol"])
+    stale_csv_names = [csv_name for csv_name in csv_mtimes if csv_name not in summarised_csv_names]
+    # start the largest csvs first, so the smaller ones fill in idle workers at the end
+    stale_csv_names.sort(key=lambda csv_name: os.path.getsize(f"{data_dir}{csv_name}"), reverse=True)
 
-    per_symbol_data = []
-    for csv_name in csv_names:
-        data = load_data_from_csv(f"{PATH_TO_DATA}{lcase_exchange}_data/{csv_name}")
+    data_processor = DataProcessing(lcase_exchange)
+
+    def load_one(csv_name):
         # Extract data from csv
-        data_processor = DataProcessing(lcase_exchange)
         try:
-            trades = data_processor.process_trades(data)
+            trades = data_processor.process_trades_from_csv(f"{data_dir}{csv_name}")
         except:
             # Skip csv if no data
-            continue
-        avg_price = data_processor.average_price(trades)
-        avg_quantity = data_processor.average_quantity(trades)
-        total_volume = data_processor.total_volume(trades)
-        per_symbol_data.append([csv_name, avg_price, avg_quantity, total_volume])
+            return None
+        avg_price, avg_quantity, total_volume = data_processor.summarise(trades)
+        return [csv_name, avg_price, avg_quantity, total_volume, csv_mtimes[csv_name]]
+
+    # file reads and the numba parser both release the GIL, so csvs are loaded in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        new_rows = [row for row in executor.map(load_one, stale_csv_names) if row is not None]
+
+    if new_rows:
+        new_summary_df = pd.DataFrame(new_rows, columns=SUMMARY_COLUMNS)
+        summary_df = pd.concat([summary_df, new_summary_df], ignore_index=True) if len(summary_df) else new_summary_df
+    if new_rows or len(summary_df) != len(saved_summary_df):
+        summary_df.to_parquet(summary_path, index=False)
+    return summary_df
+
+def plot_overall_from_csvs(exchange: str):
+    fig = Figure()
+    ax1 = fig.add_subplot(111)
+
+    summary_df = load_exchange_summary(exchange)
+    per_symbol_data = list(summary_df[["symbol", "avg_price", "avg_quantity", "total_volume"]].itertuples(index=False, name=None))
 
     # Plot data
-    symbol_data_df = pd.DataFrame(per_symbol_data, columns=["symbol", "avg_price", "avg_quantity", "total_volume"])
-    symbol_data_df.sort_values(by="total_volume", ascending=False, inplace=True)
-    symbol_data_df.reset_index(drop=True, inplace=True)
-    symbol_data_df["symbol"] = symbol_data_df["symbol"].apply(lambda x: x.split("_")[1].split(".")[0].upper())
-    
-    # take only top 10
-    symbol_data_df_top10 = symbol_data_df.loc[:10]
+    per_symbol_data.sort(key=operator.itemgetter(3), reverse=True)
+    per_symbol_data = [(SYMBOL_FROM_CSV_NAME.match(csv_name).group(1).upper(), avg_price, avg_quantity, total_volume)
+                       for csv_name, avg_price, avg_quantity, total_volume in per_symbol_data]
 
-    # foqmat data
-    symbol_data_df_top10["avg_price"] = symbol_data_df_top10["avg_price"].apply(lambda x: round(x, 2))
-    symbol_data_df_top10["avg_quantity"] = symbol_data_df_top10["avg_quantity"].apply(lambda x: round(x, 2))
-    symbol_data_df_top10["total_volume"] = symbol_data_df_top10["total_volume"].apply(lambda x: round(x, 2))
+    # take only top 10
+    top10 = per_symbol_data[:10]
 
-    ax1.bar(symbol_data_df_top10["symbol"], symbol_data_df_top10["total_volume"])
+    ax1.bar([row[0] for row in top10], [round(row[3], 2) for row in top10])
     ax1.set_title(f"{exchange} Top 10 Symbols by Volume")
     ax1.set_xlabel("Symbol")
     ax1.set_ylabel("Volume")
 
-    print(symbol_data_df)
+    for row in per_symbol_data:
+        print(*row)
 
     return fig
     
@@ -256,8 +431,14 @@ class Plot_Symbols_Widget(QtWidgets.QWidget):
         self.plot_widget = QtWidgets.QWidget()
         self.plot_layout = QtWidgets.QVBoxLayout()
         self.plot_widget.setLayout(self.plot_layout)
-        self.plot_canvas = QtWidgets.QWidget()
-        self.plot_toolbar = QtWidgets.QToolBar()
+        # one figure is kept for the widget's lifetime, and each plot only replaces the line's data
+        self.fig = Figure()
+        self.ax = self.fig.add_subplot(111)
+        (self.line,) = self.ax.plot([], [])
+        self.ax.set_xlabel("Time")
+        self.ax.set_ylabel("Price")
+        self.plot_canvas = FigureCanvas(self.fig)
+        self.plot_toolbar = NavigationToolbar(self.plot_canvas, self)
         self.plot_layout.addWidget(self.plot_canvas)
         self.plot_layout.addWidget(self.plot_toolbar)
         self.layout = QtWidgets.QGridLayout()
@@ -293,24 +474,20 @@ class Plot_Symbols_Widget(QtWidgets.QWidget):
         self.metric_selector.addItem("Trades")
     
     def plot(self):
-        # clear plot layout
-        for i in reversed(range(self.plot_layout.count())):
-            self.plot_layout.itemAt(i).widget().setParent(None)
-        # plot
         exchange = self.exchange_selector.currentText()
         symbol = self.symbol_selector.currentText()
         metric = self.metric_selector.currentText()
         if metric == "Trades":
-            fig = plot_trades_from_csv(exchange, symbol)
-            self.plot_canvas = FigureCanvas(fig)
-            self.plot_toolbar = NavigationToolbar(self.plot_canvas, self)
-            self.plot_layout.addWidget(self.plot_canvas)
-            self.plot_layout.addWidget(self.plot_toolbar)
-            self.plot_canvas.draw()
-            self.plot_canvas.show()
-            self.plot_toolbar.show()
-            self.plot_layout.update()
-            self.plot_layout.activate()
+            ts, prices = downsample_trades(load_trades_from_csv(exchange, symbol))
+            # the axis has no units until the first plot, so set them from the timestamps before updating the line
+            self.ax.xaxis.update_units(ts)
+            self.line.set_data(ts, prices)
+            self.ax.set_title(f"{exchange} {symbol} Trades")
+            self.ax.relim()
+            self.ax.autoscale_view()
+            # forget zoom/pan history from the previous symbol
+            self.plot_toolbar.update()
+            self.plot_canvas.draw_idle()
 
 class Plot_Exchange_Widget(QtWidgets.QWidget):
     def __init__(self):
@@ -351,11 +528,7 @@ class Plot_Exchange_Widget(QtWidgets.QWidget):
         self.plot_layout.addWidget(self.plot_canvas)
         self.plot_layout.addWidget(self.plot_toolbar)
 
-        self.plot_canvas.draw()
-        self.plot_canvas.show()
-        self.plot_toolbar.show()
-        self.plot_layout.update()
-        self.plot_layout.activate()
+        self.plot_canvas.draw_idle()
 
     def plot_overall_exchange(self, exchange):
         return plot_overall_from_csvs(exchange)
@@ -0,0 +1,30 @@
+import unittest
+
+from classes.fast_clean import clean_klines
+
+
+class CleanKlinesTest(unittest.TestCase):
+    def test_keeps_valid_rows_unchanged(self):
+        rows = [[1700000000, "1.5", "2", 3.0], [1700000060, "1.6", "2.1", 3.5]]
+        self.assertEqual(clean_klines(rows), rows)
+
+    def test_drops_incomplete_rows(self):
+        rows = [[1700000000, "1.5", "2", 3.0], [0, "1.6", "2.1", 3.5], [1700000120, "nan", "2.1", 3.5]]
+        self.assertEqual(clean_klines(rows), rows[:1])
+
+    def test_drops_malformed_rows_without_losing_the_batch(self):
+        rows = [
+            [1700000000, "1.5", "2", 3.0],
+            [1700000060, "not a number", "2.1", 3.5],
+            [1700000120, "1.7", "2.2"],
+            [1700000180, "1.8", "2.3", None],
+            [1700000240, "1.9", "2.4", 4.0],
+        ]
+        self.assertEqual(clean_klines(rows), [rows[0], rows[4]])
+
+    def test_empty_batch(self):
+        self.assertEqual(clean_klines([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()